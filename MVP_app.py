@@ -17,13 +17,20 @@ import geopandas as gpd
 import utm
 from shapely.geometry import shape, Polygon, mapping
 import plotly.express as px
+import plotly.graph_objects as go
 import os
 
 import torch
 
 # Import the model and functions from model_utils
-from MVP_model_utils import CNNFeatureExtractor, HybridModel
-from MVP_inference_utils import load_evi_data_and_prepare_features, predict_weekly_yield
+from MVP_model_utils import load_model
+from MVP_onnx_utils import OnnxYieldModel
+from MVP_inference_server import InferenceClient, WorkerPool, parse_address
+from MVP_inference_utils import cached_weekly_yield, cached_weekly_yield_bands, load_normalization_stats, DateIndex, enable_bf16, load_backtest_inputs
+from MVP_inference_utils import load_evi_data_and_prepare_features, weekly_inputs
+from MVP_occlusion_utils import aoi_occlusion_map
+from MVP_cache_utils import PredictionCache, SingleFlight, file_sha256, make_cache_key
+from MVP_artifact_utils import is_model_artifact, read_artifact_metadata
 
 
 #import image handler functions from landsat_handler
@@ -32,17 +39,82 @@ from landsat_handler import retrieve_latest_images, convert_selected_area, mask_
 # Load weekly yield data
 yield_data_weekly = pd.read_csv('yield_data_weekly.csv', index_col='Date')
 yield_data_weekly.index = pd.to_datetime(yield_data_weekly.index)
+yield_date_index = DateIndex(yield_data_weekly.index)
 
 #latest evi image location
 evi_data_dir = './latest_masked_evi'
 
 # Load the latest trained model
 target_shape= (512,512)
-model_path = 'trained-full-dataset.pt'
-cnn_feature_extractor = CNNFeatureExtractor()
-model = HybridModel(cnn_feature_extractor)
-model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
-model.eval() 
+# AGRISENSE_MODEL can point at a single-file artifact written by MVP_artifact_utils instead of a .pt state dict;
+# its weights are memory-mapped and the preprocessing stats bundled in it are used
+model_path = os.environ.get('AGRISENSE_MODEL', 'trained-full-dataset.pt')
+# Normalization stats frozen at training time (None, None falls back to computing them from the scene directory)
+if is_model_artifact(model_path):
+    artifact_metadata = read_artifact_metadata(model_path, target_shape)
+    train_mean, train_std = artifact_metadata['mean'], artifact_metadata['std']
+else:
+    train_mean, train_std = load_normalization_stats(model_path, target_shape)
+# The app only uses the summed yield, so load the collapsed 64 -> 1 head instead of the 512x512 per-pixel one.
+# Cached so the model is built once per server process instead of on every script rerun.
+# Set AGRISENSE_ONNX_MODEL to a file written by MVP_onnx_utils.export_onnx to serve with ONNX Runtime instead,
+# or AGRISENSE_QUANTIZE=1 to use the dynamic int8 model. Set AGRISENSE_INFERENCE_SERVER to the host:port of a
+# running MVP_inference_server.py (and AGRISENSE_INFERENCE_AUTHKEY to its auth key) to send predictions there and
+# batch them with other sessions.
+# AGRISENSE_WORKERS=N runs the model in N worker processes, each pinned to its own share of the cores, so
+# concurrent sessions run side by side instead of contending for one torch thread pool.
+# AGRISENSE_BF16=1 runs the CNN and head in bfloat16 if the CPU supports it and the predictions for the most
+# recent BF16_CHECK_WEEKS weeks stay within MVP_inference_utils.BF16_MAX_RELATIVE_ERROR of fp32.
+BF16_CHECK_WEEKS = 8
+@st.cache_resource
+def get_model(model_path):
+    inference_server = os.environ.get('AGRISENSE_INFERENCE_SERVER')
+    if inference_server:
+        return InferenceClient(parse_address(inference_server))
+    onnx_model_path = os.environ.get('AGRISENSE_ONNX_MODEL')
+    if onnx_model_path:
+        return OnnxYieldModel(onnx_model_path)
+    quantize = os.environ.get('AGRISENSE_QUANTIZE') == '1'
+    workers = os.environ.get('AGRISENSE_WORKERS')
+    if workers:
+        return WorkerPool(model_path, int(workers), total_yield=True, quantize=quantize)
+    model = load_model(model_path, total_yield=True, quantize=quantize)
+    if os.environ.get('AGRISENSE_BF16') == '1' and not quantize:
+        check_weeks = yield_data_weekly.tail(BF16_CHECK_WEEKS)
+        evi_frames, time_features, mean, std = load_backtest_inputs(evi_data_dir, check_weeks, target_shape, train_mean, train_std)
+        enabled, relative_error = enable_bf16(model, evi_frames, time_features, mean, std, target_shape)
+        print(f"bfloat16 inference {'enabled' if enabled else 'disabled'} (relative error vs fp32: {relative_error})")
+    return model
+
+model = get_model(model_path)
+
+# Identifies the served model in the prediction cache: the checkpoint checksum plus the backend settings above
+# and the normalization stats the forecasts are computed with
+@st.cache_resource
+def get_model_version(model_path, bf16, train_mean, train_std):
+    onnx_model_path = os.environ.get('AGRISENSE_ONNX_MODEL')
+    return make_cache_key(file_sha256(model_path), 'total_yield',
+                          file_sha256(onnx_model_path) if onnx_model_path else '',
+                          os.environ.get('AGRISENSE_QUANTIZE', ''),
+                          'bf16' if bf16 else '',
+                          train_mean, train_std)
+
+if os.environ.get('AGRISENSE_INFERENCE_SERVER'):
+    # The server may run a different checkpoint than model_path, so take the model's identity from it. Asked on
+    # every run because the server can be restarted with another model while this process keeps running.
+    model_version = make_cache_key(model.model_version(), train_mean, train_std)
+else:
+    model_version = get_model_version(model_path, getattr(model, 'bf16', False), train_mean, train_std)
+# Forecasts shared by all sessions and kept across restarts
+prediction_cache = PredictionCache()
+
+# One per server process: sessions asking for a forecast that another session is already computing wait for
+# that result instead of running the same pipeline again (counters in get_single_flight().stats())
+@st.cache_resource
+def get_single_flight():
+    return SingleFlight()
+
+single_flight = get_single_flight()
 
 
 
@@ -466,15 +538,11 @@ if view == "Crop Health":
 
                     start_date = pd.to_datetime(st.session_state['masked_date']) # input date of latest EVI image
 
-                    polygon_area_acres = st.session_state['area']/4046.8564224 # conversion to acres from square meters
-                    # Load and preprocess the EVI data
-                    time_index = [pd.to_datetime(time) for time in yield_data_weekly.index]
-
-                    evi_data_dict, time_features_list, mean, std = load_evi_data_and_prepare_features(evi_data_dir, time_index, target_shape)
-
-                    # Generate weekly predictions
+                    # Generate weekly predictions. They only depend on the scenes, start date and model, so they come from the
+                    # shared prediction cache when any session already ran them; the drawn field just rescales the result below
                     device=None
-                    dates, predicted_yields = predict_weekly_yield(evi_data_dict, yield_data_weekly, start_date, polygon_area_acres, mean, std, target_shape, model, device)
+                    dates, predicted_yields = cached_weekly_yield(prediction_cache, model_version, evi_data_dir, yield_data_weekly, start_date, target_shape, model, device,
+                                                                  mean=train_mean, std=train_std, yield_date_index=yield_date_index, single_flight=single_flight)
 
                     # Convert predictions to a numpy array
                     predicted_yields = np.array(predicted_yields).flatten()
@@ -801,6 +869,59 @@ else:
 
             st.plotly_chart(fig)
 
+        # Forecast for the next 13 weeks with a Monte Carlo dropout band (5th-95th percentile). All samples run as one
+        # batched forward pass and the result is shared through the prediction cache. Only the PyTorch model can
+        # sample dropout, the ONNX / inference server backends just show the historical comparison above.
+        def plot_forecast_bands():
+            if not isinstance(model, torch.nn.Module) or st.session_state.get('masked_date') is None:
+                return
+            start_date = pd.to_datetime(st.session_state['masked_date'])
+            dates, bands = cached_weekly_yield_bands(prediction_cache, model_version, evi_data_dir, yield_data_weekly, start_date, target_shape, model, None,
+                                                     mean=train_mean, std=train_std, yield_date_index=yield_date_index, single_flight=single_flight)
+
+            area = round(st.session_state["area"]/4046.8564224,1)
+            #distribute yield by share of farm size
+            scale = area/79500
+
+            fig = go.Figure([
+                go.Scatter(x=dates, y=[value*scale for value in bands['p95']], mode='lines', line=dict(width=0), showlegend=False, hoverinfo='skip'),
+                go.Scatter(x=dates, y=[value*scale for value in bands['p5']], mode='lines', line=dict(width=0), fill='tonexty',
+                           fillcolor='rgba(255, 75, 75, 0.2)', name='90% Band'),
+                go.Scatter(x=dates, y=[value*scale for value in bands['mean']], mode='lines+markers', line=dict(color='rgb(255, 75, 75)'), name='Predicted Yield'),
+            ])
+            fig.update_layout(
+                title='Strawberry Yield Forecast with Uncertainty',
+                xaxis_title='Time',
+                yaxis_title='Yield (lbs of strawberries per week)',
+                legend_title='',
+                width=1000,
+                height=600
+            )
+
+            st.plotly_chart(fig)
+
+        # Occlusion map of this week's forecast over the drawn field: each patch of the latest scene inside the AOI is
+        # hidden in turn (all variants run in a few batched passes) and the drop in the predicted total is shown
+        def plot_occlusion_map():
+            if st.session_state.get('masked_date') is None:
+                return
+            start_date = pd.to_datetime(st.session_state['masked_date'])
+            scene_files = [file for file in os.listdir(evi_data_dir) if file.endswith('.tiff') and file.split('_')[3] == start_date.strftime('%Y%m%d')]
+            if not scene_files:
+                return
+            evi_data_dict, _, mean, std = load_evi_data_and_prepare_features(evi_data_dir, [start_date], target_shape, mean=train_mean, std=train_std)
+            _, evi_frames, time_features = weekly_inputs(evi_data_dict, yield_data_weekly, start_date, 1, yield_date_index)
+            heatmap, _, _ = aoi_occlusion_map(evi_frames[0], os.path.join(evi_data_dir, scene_files[0]), st.session_state['aoi'], time_features[0],
+                                              mean, std, target_shape, model, None)
+
+            area = round(st.session_state["area"]/4046.8564224,1)
+            fig = px.imshow(heatmap*area/79500, color_continuous_scale='RdBu', color_continuous_midpoint=0,
+                            labels={'color': 'lbs / week'}, title="What Drives This Week's Forecast (yield lost when each area is hidden)")
+            fig.update_xaxes(showticklabels=False)
+            fig.update_yaxes(showticklabels=False)
+            fig.update_layout(width=1000, height=600)
+            st.plotly_chart(fig)
+
 
 
 
@@ -829,6 +950,9 @@ else:
             message.empty()
 
         plot_yield_prediction()
+        plot_forecast_bands()
+        if st.sidebar.button("Explain Forecast", help="Show which parts of the field drive this week's forecast"):
+            plot_occlusion_map()
 
 
 
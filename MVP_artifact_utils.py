@@ -0,0 +1,213 @@
+import argparse
+import json
+import math
+import os
+import struct
+
+import numpy as np
+import torch
+from sklearn.preprocessing import MinMaxScaler
+
+from MVP_inference_utils import TIME_FEATURE_COLUMNS, load_normalization_stats, scaled_volume_columns
+from MVP_model_utils import CNNFeatureExtractor, HybridModel, load_model, prepare_for_inference
+
+# Model artifacts use the safetensors layout: an 8-byte little-endian header length, a JSON header mapping each
+# tensor name to its dtype, shape and byte range, then the raw tensor data. The preprocessing the model was
+# trained with goes in the header's "__metadata__" entry, so one file carries everything inference needs.
+ARTIFACT_SUFFIX = '.safetensors'
+ARTIFACT_FORMAT = 'agrisense-model/1'
+
+_DTYPES = {
+    'F64': torch.float64,
+    'F32': torch.float32,
+    'F16': torch.float16,
+    'BF16': torch.bfloat16,
+    'I64': torch.int64,
+    'I32': torch.int32,
+}
+_DTYPE_NAMES = {dtype: name for name, dtype in _DTYPES.items()}
+
+
+# Function to check whether a path is a model artifact rather than a pickled state dict
+def is_model_artifact(path):
+    return str(path).endswith(ARTIFACT_SUFFIX)
+
+
+# Function to turn a fitted MinMaxScaler into plain JSON values
+def scaler_to_dict(scaler):
+    return {
+        'feature_names': [str(name) for name in getattr(scaler, 'feature_names_in_', [])],
+        'feature_range': list(scaler.feature_range),
+        'data_min': scaler.data_min_.tolist(),
+        'data_max': scaler.data_max_.tolist(),
+        'n_samples_seen': int(scaler.n_samples_seen_),
+    }
+
+
+# Function to rebuild a fitted MinMaxScaler from scaler_to_dict output
+def scaler_from_dict(values):
+    scaler = MinMaxScaler(feature_range=tuple(values['feature_range']))
+    data_min = np.array(values['data_min'], dtype=np.float64)
+    data_max = np.array(values['data_max'], dtype=np.float64)
+    # Mirrors MinMaxScaler.partial_fit, constant columns get a scale of 1 like sklearn does
+    data_range = data_max - data_min
+    feature_min, feature_max = scaler.feature_range
+    scaler.scale_ = (feature_max - feature_min) / np.where(data_range == 0, 1.0, data_range)
+    scaler.min_ = feature_min - data_min * scaler.scale_
+    scaler.data_min_ = data_min
+    scaler.data_max_ = data_max
+    scaler.data_range_ = data_range
+    scaler.n_samples_seen_ = values['n_samples_seen']
+    scaler.n_features_in_ = len(data_min)
+    if values['feature_names']:
+        scaler.feature_names_in_ = np.array(values['feature_names'], dtype=object)
+    return scaler
+
+
+# Function to write a model and the preprocessing it was trained with to a single artifact file.
+# mean/std are the EVI normalization stats, yield_scaler the MinMaxScaler fitted on the yield volume columns: both
+# with MVP_utils.process_yield_data, only 'Volume (Pounds)' with the shipped yield_scaler.save. The columns it covers
+# are checked (see scaled_volume_columns). Quantized models have no plain tensors to store, save the fp32 model.
+def save_model_artifact(path, model, mean, std, target_shape, yield_scaler=None, time_feature_columns=TIME_FEATURE_COLUMNS):
+    if yield_scaler is not None:
+        scaled_volume_columns(yield_scaler)
+    state_dict = model.state_dict()
+    if not all(isinstance(tensor, torch.Tensor) and tensor.dtype in _DTYPE_NAMES for tensor in state_dict.values()):
+        raise ValueError("Only fp32 / bf16 models can be saved as an artifact, save the model before quantizing it")
+
+    # Largest items first, so every tensor starts at a multiple of its own item size
+    names = sorted(state_dict, key=lambda name: -state_dict[name].element_size())
+    header = {}
+    offset = 0
+    for name in names:
+        tensor = state_dict[name]
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {'dtype': _DTYPE_NAMES[tensor.dtype], 'shape': list(tensor.shape), 'data_offsets': [offset, offset + size]}
+        offset += size
+    metadata = {
+        'format': ARTIFACT_FORMAT,
+        'mean': float(mean),
+        'std': float(std),
+        'target_shape': list(target_shape),
+        'time_feature_columns': list(time_feature_columns),
+        'total_yield': bool(model.total_yield),
+        'scalar_target': bool(model.scalar_target),
+        'yield_scaler': scaler_to_dict(yield_scaler) if yield_scaler is not None else None,
+    }
+    # safetensors metadata values are strings
+    header['__metadata__'] = {key: json.dumps(value) for key, value in metadata.items()}
+    header_bytes = json.dumps(header).encode('utf-8')
+    # Pad the header so the data section starts 8-byte aligned
+    header_bytes += b' ' * (-(8 + len(header_bytes)) % 8)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for name in names:
+            f.write(state_dict[name].detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy())
+    os.replace(tmp_path, path)
+    return path
+
+
+# Function to read and validate an artifact header. Returns (tensor entries, metadata, data start offset)
+def _read_header(path):
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        prefix = f.read(8)
+        if len(prefix) < 8:
+            raise ValueError(f"{path} is not a model artifact (file too short)")
+        header_size = struct.unpack('<Q', prefix)[0]
+        if 8 + header_size > file_size:
+            raise ValueError(f"{path} is not a model artifact (header size {header_size} exceeds file size)")
+        header = json.loads(f.read(header_size))
+    data_start = 8 + header_size
+    raw_metadata = header.pop('__metadata__', {})
+    metadata = {key: json.loads(value) for key, value in raw_metadata.items()}
+    if metadata.get('format') != ARTIFACT_FORMAT:
+        raise ValueError(f"{path} has artifact format {metadata.get('format')!r}, expected {ARTIFACT_FORMAT!r}")
+    for name, entry in header.items():
+        start, end = entry['data_offsets']
+        if entry['dtype'] not in _DTYPES:
+            raise ValueError(f"{path}: tensor {name} has unsupported dtype {entry['dtype']}")
+        expected_size = math.prod(entry['shape']) * _DTYPES[entry['dtype']].itemsize
+        if end - start != expected_size or start < 0 or data_start + end > file_size:
+            raise ValueError(f"{path}: tensor {name} has an invalid byte range {entry['data_offsets']}")
+    return header, metadata, data_start
+
+
+# Function to read and validate the preprocessing metadata of an artifact without touching the weights.
+# Raises ValueError when it does not match what this code feeds the model: the target_shape passed in (if any),
+# the time-feature columns in model input order, a usable mean/std and a yield scaler fitted on volume columns.
+def read_artifact_metadata(path, target_shape=None):
+    _, metadata, _ = _read_header(path)
+    if target_shape is not None and tuple(metadata['target_shape']) != tuple(target_shape):
+        raise ValueError(f"{path} was trained for target_shape {tuple(metadata['target_shape'])}, not {tuple(target_shape)}")
+    if metadata['time_feature_columns'] != TIME_FEATURE_COLUMNS:
+        raise ValueError(f"{path} expects time features {metadata['time_feature_columns']}, this code provides {TIME_FEATURE_COLUMNS}")
+    if not (math.isfinite(metadata['mean']) and math.isfinite(metadata['std']) and metadata['std'] > 0):
+        raise ValueError(f"{path} has invalid normalization stats mean={metadata['mean']} std={metadata['std']}")
+    metadata['target_shape'] = tuple(metadata['target_shape'])
+    if metadata['yield_scaler'] is not None:
+        metadata['yield_scaler'] = scaler_from_dict(metadata['yield_scaler'])
+        try:
+            scaled_volume_columns(metadata['yield_scaler'])
+        except ValueError as e:
+            raise ValueError(f"{path}: {e}") from None
+    return metadata
+
+
+# Function to memory-map the tensors of an artifact. The file is mapped copy-on-write, so the weights stay in
+# the page cache and are shared by every process that loads the same file until one of them writes to them.
+# mmap=False copies each tensor out of the mapping instead, so tensors that are later replaced (e.g. by
+# quantization) free their memory rather than keeping the whole file mapped.
+def load_artifact_state_dict(path, mmap=True):
+    header, _, data_start = _read_header(path)
+    buffer = np.memmap(path, dtype=np.uint8, mode='c')
+    state_dict = {}
+    for name, entry in header.items():
+        start, end = entry['data_offsets']
+        dtype = _DTYPES[entry['dtype']]
+        tensor = torch.frombuffer(buffer, dtype=dtype, count=(end - start) // dtype.itemsize, offset=data_start + start) if end > start \
+            else torch.empty(0, dtype=dtype)
+        state_dict[name] = tensor.view(entry['shape']) if mmap else tensor.view(entry['shape']).clone()
+    return state_dict
+
+
+# Function to load a model artifact for inference. Returns (model, metadata) where metadata holds the validated
+# preprocessing (mean, std, target_shape, time_feature_columns, yield_scaler); the other options follow load_model.
+def load_model_artifact(path, total_yield=False, device='cpu', quantize=False, target_shape=None):
+    metadata = read_artifact_metadata(path, target_shape)
+    if metadata['total_yield'] and not total_yield:
+        raise ValueError(f"{path} holds a collapsed total-yield model, load it with total_yield=True")
+    with torch.device('meta'):
+        model = HybridModel(CNNFeatureExtractor(metadata['target_shape']), scalar_target=metadata.get('scalar_target', False))
+    if metadata['total_yield']:
+        model.collapse_to_total_yield()
+    model.load_state_dict(load_artifact_state_dict(path, mmap=not quantize), assign=True)
+    return prepare_for_inference(model, total_yield, device, quantize), metadata
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a pickled state dict and its preprocessing stats into a single model artifact")
+    parser.add_argument('--model', default='trained-full-dataset.pt')
+    parser.add_argument('--yield-scaler', default='yield_scaler.save',
+                        help="joblib MinMaxScaler fitted on yield volume columns (yield_scaler.save covers 'Volume (Pounds)' only)")
+    parser.add_argument('--output', default=None, help=f"Defaults to the model path with a {ARTIFACT_SUFFIX} suffix")
+    parser.add_argument('--target-shape', nargs=2, type=int, default=[512, 512])
+    args = parser.parse_args()
+
+    import joblib
+
+    target_shape = tuple(args.target_shape)
+    mean, std = load_normalization_stats(args.model, target_shape)
+    if mean is None:
+        raise SystemExit(f"No normalization stats saved next to {args.model}, see MVP_inference_utils.save_normalization_stats")
+    yield_scaler = joblib.load(args.yield_scaler) if os.path.exists(args.yield_scaler) else None
+    output = args.output or os.path.splitext(args.model)[0] + ARTIFACT_SUFFIX
+    save_model_artifact(output, load_model(args.model), mean, std, target_shape, yield_scaler)
+    print(f"Wrote {output}")
+
+
+if __name__ == '__main__':
+    main()
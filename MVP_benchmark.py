@@ -0,0 +1,381 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import psutil
+import rasterio
+import torch
+from rasterio.transform import from_origin
+from skimage.transform import resize
+
+from MVP_inference_utils import (
+    EVI_RESAMPLING,
+    TIME_FEATURE_COLUMNS,
+    check_resampling_fidelity,
+    enable_bf16,
+    load_backtest_inputs,
+    load_normalization_stats,
+    predict_batch,
+    read_resized_evi_data,
+    run_model,
+)
+from MVP_inference_server import WorkerPool
+from MVP_model_utils import CNNFeatureExtractor, HybridModel, load_model
+from MVP_utils import load_evi_data
+
+
+# Function to time fn over several repeats after a few warmup calls, returns per-call latencies in ms
+def time_calls(fn, repeats, warmup=1):
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies)
+
+
+# Function to summarize per-call latencies for a call that makes batch_size predictions
+def summarize_latencies(latencies, batch_size):
+    return {
+        'latency_ms_mean': float(latencies.mean()),
+        'latency_ms_p50': float(np.percentile(latencies, 50)),
+        'latency_ms_p95': float(np.percentile(latencies, 95)),
+        'throughput_per_s': float(batch_size * 1000 / latencies.mean()),
+    }
+
+
+# Function to build synthetic model inputs: n_sequences distinct EVI sequences and batch_size time-feature
+# rows spread across them
+def synthetic_model_inputs(n_sequences, batch_size, sequence_length, target_shape, n_time_features=6, seed=0):
+    rng = np.random.default_rng(seed)
+    evi_sequences = rng.standard_normal((n_sequences, sequence_length, 1, *target_shape)).astype(np.float32)
+    time_features = rng.standard_normal((batch_size, n_time_features)).astype(np.float32)
+    frame_index = np.arange(batch_size, dtype=np.int64) % n_sequences
+    return evi_sequences, time_features, frame_index
+
+
+# Function to measure latency and throughput of each backend ({name: model}) over the given batch sizes.
+# Every batch uses distinct EVI sequences, so this measures the full CNN + LSTM + head cost per prediction.
+def benchmark_backends(backends, target_shape, batch_sizes, sequence_length=1, repeats=5, warmup=1):
+    results = []
+    for name, model in backends.items():
+        for batch_size in batch_sizes:
+            evi_sequences, time_features, frame_index = synthetic_model_inputs(batch_size, batch_size, sequence_length, target_shape)
+            latencies = time_calls(lambda: run_model(model, evi_sequences, time_features, frame_index, 'cpu'), repeats, warmup)
+            results.append({'backend': name, 'batch_size': batch_size, 'sequence_length': sequence_length, **summarize_latencies(latencies, batch_size)})
+            print(f"{name:>12} batch {batch_size:>3}: {results[-1]['latency_ms_mean']:.1f} ms, {results[-1]['throughput_per_s']:.2f} predictions/s")
+    return results
+
+
+# Function to build every requested backend from a loaded torch model. The ONNX model is exported to a
+# temporary file when no onnx_path is given.
+def load_backends(torch_model, backend_names, onnx_path=None):
+    backends = {}
+    for name in backend_names:
+        if name == 'torch':
+            backends[name] = torch_model
+        elif name == 'onnx':
+            from MVP_onnx_utils import OnnxYieldModel, check_onnx_parity, export_onnx
+            if onnx_path is None:
+                onnx_path = export_onnx(torch_model, os.path.join(tempfile.mkdtemp(), 'model.onnx'))
+            backends[name] = OnnxYieldModel(onnx_path, intra_op_num_threads=torch.get_num_threads())
+            print(f"ONNX parity vs torch (max relative difference): {check_onnx_parity(torch_model, backends[name]):.2e}")
+        else:
+            raise ValueError(f"Unknown backend {name!r}")
+    return backends
+
+
+# Function to measure WorkerPool throughput under concurrent load for each worker count: `concurrency` threads
+# each send `requests_per_thread` single-sequence predictions. The in-process torch model is the baseline.
+def worker_pool_report(model_path, worker_counts, concurrency, requests_per_thread=4):
+    baseline = load_model(model_path, total_yield=True)
+    evi_sequences, time_features, frame_index = synthetic_model_inputs(1, 1, 1, baseline.target_shape)
+
+    def run_load(model):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(lambda _: [run_model(model, evi_sequences, time_features, frame_index, 'cpu') for _ in range(requests_per_thread)],
+                              range(concurrency)))
+        return concurrency * requests_per_thread / (time.perf_counter() - start)
+
+    run_model(baseline, evi_sequences, time_features, frame_index, 'cpu')
+    results = [{'workers': 0, 'threads_per_worker': torch.get_num_threads(), 'throughput_per_s': run_load(baseline)}]
+    del baseline
+    for n_workers in worker_counts:
+        with WorkerPool(model_path, n_workers) as pool:
+            # One request per worker first, so the timing below does not include warmup
+            [future.result() for future in [pool.submit(evi_sequences, time_features, frame_index) for _ in pool.workers]]
+            results.append({'workers': len(pool.workers), 'threads_per_worker': [len(cores) for cores in pool.core_sets],
+                            'throughput_per_s': run_load(pool)})
+    for result in results:
+        name = 'in-process' if result['workers'] == 0 else f"{result['workers']} workers"
+        print(f"{name:>12}: {result['throughput_per_s']:.2f} predictions/s with {concurrency} concurrent callers")
+    return {'concurrency': concurrency, 'requests_per_thread': requests_per_thread, 'cpu_count': os.cpu_count(), 'results': results}
+
+
+# Function to write synthetic int16 EVI GeoTIFFs named like the masked scenes (date in the 4th '_' field),
+# one every 16 days (the Landsat revisit) from start_date
+def write_synthetic_scenes(directory, n_scenes, raster_shape, start_date='2024-03-03', seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for date in pd.date_range(start_date, periods=n_scenes, freq='16D'):
+        path = os.path.join(directory, f"LC09_CU_masked_{date:%Y%m%d}_EVI.tiff")
+        with rasterio.open(path, 'w', driver='GTiff', height=raster_shape[0], width=raster_shape[1], count=1, dtype='int16',
+                           crs='EPSG:32610', transform=from_origin(700000, 3900000, 30, 30)) as dst:
+            dst.write((rng.random(raster_shape) * 10000).astype(np.int16), 1)
+        paths.append(path)
+    return paths
+
+
+# Function to build a synthetic weekly yield table with the model's time-feature columns
+def synthetic_yield_table(start_date, weeks, seed=0):
+    rng = np.random.default_rng(seed)
+    index = pd.date_range(start_date, periods=weeks, freq='W', name='Date')
+    return pd.DataFrame({
+        'month_sin': np.sin(2 * np.pi * index.month / 12),
+        'month_cos': np.cos(2 * np.pi * index.month / 12),
+        'day_of_year_sin': np.sin(2 * np.pi * index.dayofyear / 365),
+        'day_of_year_cos': np.cos(2 * np.pi * index.dayofyear / 365),
+        'Volume (Pounds)': rng.random(weeks),
+        'Cumulative Volumne (Pounds)': np.sort(rng.random(weeks)),
+    }, index=index)
+
+
+# Function to time each stage of predict_weekly_yield separately for one configuration: decimated raster read,
+# normalize, tensor build, CNN, LSTM and head. resampling=None times the full read + skimage resize path instead,
+# as separate load and resize stages (see read_resized_evi_data). Returns the median ms per stage over the repeats.
+def benchmark_stages(scene_paths, yield_data_weekly, batch_size, sequence_length, target_shape, threads, repeats=3, total_yield=True,
+                     resampling=EVI_RESAMPLING):
+    torch.set_num_threads(threads)
+    with torch.device('meta'):
+        model = HybridModel(CNNFeatureExtractor(target_shape))
+    # Timings do not depend on the weight values, so random weights at the swept target_shape are enough
+    model = model.to_empty(device='cpu')
+    for module in model.modules():
+        if hasattr(module, 'reset_parameters'):
+            module.reset_parameters()
+    if total_yield:
+        model.collapse_to_total_yield()
+    model.eval()
+
+    paths = [scene_paths[i % len(scene_paths)] for i in range(batch_size * sequence_length)]
+    time_features = yield_data_weekly[TIME_FEATURE_COLUMNS].values[:batch_size].astype(np.float32)
+    read_stages = ('decimated_read',) if resampling else ('load', 'resize')
+    stages = {name: [] for name in (*read_stages, 'normalize', 'tensor_build', 'cnn', 'lstm', 'head')}
+
+    def timed(name, fn):
+        start = time.perf_counter()
+        result = fn()
+        stages[name].append((time.perf_counter() - start) * 1000)
+        return result
+
+    for _ in range(repeats):
+        if resampling:
+            images = timed('decimated_read', lambda: [read_resized_evi_data(path, target_shape, resampling) for path in paths])
+        else:
+            images = timed('load', lambda: [load_evi_data(path) for path in paths])
+            images = timed('resize', lambda: [resize(image, target_shape, anti_aliasing=True) for image in images])
+        images = timed('normalize', lambda: [(image - 0.1) / 0.2 for image in images])
+        x = timed('tensor_build', lambda: torch.tensor(np.stack(images), dtype=torch.float32).view(batch_size, sequence_length, 1, *target_shape))
+        with torch.no_grad():
+            c_out = timed('cnn', lambda: model.cnn(x.view(batch_size * sequence_length, 1, *target_shape)))
+            r_out, state = timed('lstm', lambda: model.lstm_step(c_out.view(batch_size, sequence_length, -1)))
+            timed('head', lambda: model.head(r_out, torch.from_numpy(time_features)))
+
+    stage_ms = {name: float(np.median(timings)) for name, timings in stages.items()}
+    return {
+        'batch_size': batch_size,
+        'sequence_length': sequence_length,
+        'target_shape': list(target_shape),
+        'threads': threads,
+        'resampling': resampling,
+        'stage_ms': stage_ms,
+        'total_ms': float(sum(stage_ms.values())),
+    }
+
+
+# Function to sweep benchmark_stages over every combination of the given parameters on synthetic scenes
+def sweep_stages(batch_sizes, sequence_lengths, target_shapes, thread_counts, raster_shape, repeats=3, resampling=EVI_RESAMPLING):
+    n_scenes = max(batch_sizes) * max(sequence_lengths)
+    yield_data_weekly = synthetic_yield_table('2024-03-03', max(batch_sizes))
+    results = []
+    with tempfile.TemporaryDirectory(prefix='agrisense_bench_') as scene_dir:
+        scene_paths = write_synthetic_scenes(scene_dir, n_scenes, raster_shape)
+        for batch_size, sequence_length, target_shape, threads in itertools.product(batch_sizes, sequence_lengths, target_shapes, thread_counts):
+            result = benchmark_stages(scene_paths, yield_data_weekly, batch_size, sequence_length, target_shape, threads, repeats,
+                                      resampling=resampling)
+            results.append(result)
+            print(f"batch {batch_size:>3} seq {sequence_length:>2} shape {target_shape} threads {threads:>2}: "
+                  + ", ".join(f"{name} {ms:.1f}" for name, ms in result['stage_ms'].items()) + f" (total {result['total_ms']:.1f} ms)")
+    return {
+        'environment': {
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'cpu_count': os.cpu_count(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+        },
+        'raster_shape': list(raster_shape),
+        'resampling': resampling,
+        'results': results,
+    }
+
+
+# Function to compare decimated rasterio reads (one entry per resampling method) against the full read +
+# skimage resize path on the scenes in evi_data_dir: per-scene read latency and fidelity to the full read
+def resampling_report(evi_data_dir, target_shape, methods, repeats=3):
+    file_paths = sorted(os.path.join(evi_data_dir, file) for file in os.listdir(evi_data_dir) if file.endswith('.tiff'))
+    read_all = lambda resampling: [read_resized_evi_data(file_path, target_shape, resampling) for file_path in file_paths]
+    report = {'scenes': len(file_paths), 'target_shape': list(target_shape),
+              'full_read_resize': summarize_latencies(time_calls(lambda: read_all(None), repeats), len(file_paths))}
+    for method in methods:
+        report[method] = {
+            **summarize_latencies(time_calls(lambda: read_all(method), repeats), len(file_paths)),
+            'fidelity': check_resampling_fidelity(file_paths, target_shape, method),
+        }
+    print(json.dumps(report, indent=2))
+    return report
+
+
+# Run in a fresh process so each model variant's resident memory is measured on its own. One forward pass
+# runs before measuring, so every weight is resident, including the pages of a memory-mapped fp32 checkpoint.
+def _model_rss_mb(model_path, quantize):
+    process = psutil.Process()
+    rss_before = process.memory_info().rss
+    model = load_model(model_path, total_yield=True, quantize=quantize)
+    height, width = model.target_shape
+    run_model(model, np.zeros((1, 1, 1, height, width), dtype=np.float32),
+              np.zeros((1, model.fc1.in_features - model.lstm.hidden_size), dtype=np.float32), np.zeros(1, dtype=np.int64), 'cpu')
+    return (process.memory_info().rss - rss_before) / 2**20
+
+
+# Function to compare the dynamic int8 model against fp32 on the yield table's backtest weeks:
+# prediction drift, resident memory of the loaded model and latency of the full backtest batch
+def quantization_report(model_path, evi_data_dir, yield_data_weekly, repeats=3):
+    models = {
+        'fp32': load_model(model_path, total_yield=True),
+        'int8': load_model(model_path, total_yield=True, quantize=True),
+    }
+    target_shape = models['fp32'].target_shape
+    mean, std = load_normalization_stats(model_path, target_shape)
+    evi_frames, time_features, mean, std = load_backtest_inputs(evi_data_dir, yield_data_weekly, target_shape, mean, std)
+
+    report = {'weeks': len(time_features)}
+    predictions = {}
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        for name, model in models.items():
+            run = lambda: predict_batch(evi_frames, time_features, mean, std, target_shape, model, 'cpu')
+            predictions[name] = run()
+            report[name] = {
+                'model_rss_mb': pool.apply(_model_rss_mb, (model_path, name == 'int8')),
+                **summarize_latencies(time_calls(run, repeats, warmup=0), len(time_features)),
+            }
+
+    drift = np.abs(predictions['int8'] - predictions['fp32'])
+    report['drift'] = {
+        'mean_abs': float(drift.mean()),
+        'max_abs': float(drift.max()),
+        'mean_abs_relative': float(drift.mean() / max(np.abs(predictions['fp32']).mean(), 1e-12)),
+    }
+    print(json.dumps(report, indent=2))
+    return report
+
+
+# Function to compare the bfloat16 mode against fp32 on the yield table's backtest weeks: whether the accuracy
+# guard lets it through, the relative error and the latency of the full backtest batch in each precision
+def bf16_report(model_path, evi_data_dir, yield_data_weekly, repeats=3, max_relative_error=0.01):
+    model = load_model(model_path, total_yield=True)
+    target_shape = model.target_shape
+    mean, std = load_normalization_stats(model_path, target_shape)
+    evi_frames, time_features, mean, std = load_backtest_inputs(evi_data_dir, yield_data_weekly, target_shape, mean, std)
+    run = lambda: predict_batch(evi_frames, time_features, mean, std, target_shape, model, 'cpu')
+
+    report = {'weeks': len(time_features), 'fp32': summarize_latencies(time_calls(run, repeats), len(time_features))}
+    enabled, relative_error = enable_bf16(model, evi_frames, time_features, mean, std, target_shape, max_relative_error=max_relative_error)
+    report['bf16'] = {'enabled': enabled, 'relative_error': relative_error, 'max_relative_error': max_relative_error}
+    if enabled:
+        report['bf16'].update(summarize_latencies(time_calls(run, repeats), len(time_features)))
+    print(json.dumps(report, indent=2))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark yield model inference")
+    parser.add_argument('--model', default='trained-full-dataset.pt', help="PyTorch state dict to benchmark")
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', default=None, help="Write results as JSON to this path")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    backends_parser = subparsers.add_parser('backends', help="Latency and throughput per inference backend")
+    backends_parser.add_argument('--backends', nargs='+', default=['torch', 'onnx'], choices=['torch', 'onnx'])
+    backends_parser.add_argument('--onnx', default=None, help="Existing export_onnx output (exported on the fly when omitted)")
+    backends_parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 4, 13])
+    backends_parser.add_argument('--sequence-length', type=int, default=1)
+
+    stages_parser = subparsers.add_parser('stages', help="Per-stage timings swept over batch size, sequence length, target shape and threads")
+    stages_parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 4])
+    stages_parser.add_argument('--sequence-lengths', nargs='+', type=int, default=[1, 4])
+    stages_parser.add_argument('--target-shapes', nargs='+', type=int, default=[256, 512], help="Square target shapes to sweep")
+    stages_parser.add_argument('--threads', nargs='+', type=int, default=sorted({1, os.cpu_count() or 1}))
+    stages_parser.add_argument('--raster-shape', nargs=2, type=int, default=[1024, 1024], help="Height and width of the synthetic rasters")
+    stages_parser.add_argument('--resampling', default=EVI_RESAMPLING,
+                               help="Resampling of the decimated read predict uses, 'none' times the full read + skimage resize instead")
+
+    quantization_parser = subparsers.add_parser('quantization', help="Dynamic int8 vs fp32 drift, RSS and latency on backtest weeks")
+    quantization_parser.add_argument('--evi-dir', default='./latest_masked_evi')
+    quantization_parser.add_argument('--yield-data', default='yield_data_weekly.csv')
+
+    resampling_parser = subparsers.add_parser('resampling', help="Decimated raster reads vs full read + skimage resize: latency and fidelity")
+    resampling_parser.add_argument('--evi-dir', default='./latest_masked_evi')
+    resampling_parser.add_argument('--methods', nargs='+', default=['bilinear', 'average', 'cubic', 'nearest'])
+    resampling_parser.add_argument('--target-shape', nargs=2, type=int, default=[512, 512])
+
+    workers_parser = subparsers.add_parser('workers', help="WorkerPool throughput under concurrent load per worker count")
+    workers_parser.add_argument('--workers', nargs='+', type=int, default=sorted({1, os.cpu_count() or 1}))
+    workers_parser.add_argument('--concurrency', type=int, default=os.cpu_count() or 1, help="Concurrent callers")
+    workers_parser.add_argument('--requests-per-thread', type=int, default=4)
+
+    bf16_parser = subparsers.add_parser('bf16', help="bfloat16 vs fp32 error and latency on backtest weeks")
+    bf16_parser.add_argument('--evi-dir', default='./latest_masked_evi')
+    bf16_parser.add_argument('--yield-data', default='yield_data_weekly.csv')
+    bf16_parser.add_argument('--max-relative-error', type=float, default=0.01)
+    args = parser.parse_args()
+
+    if args.command == 'backends':
+        torch_model = load_model(args.model, total_yield=True)
+        backends = load_backends(torch_model, args.backends, args.onnx)
+        results = {'torch_threads': torch.get_num_threads(),
+                   'results': benchmark_backends(backends, torch_model.target_shape, args.batch_sizes, args.sequence_length, args.repeats)}
+    elif args.command == 'stages':
+        results = sweep_stages(args.batch_sizes, args.sequence_lengths, [(size, size) for size in args.target_shapes],
+                               args.threads, tuple(args.raster_shape), args.repeats, None if args.resampling == 'none' else args.resampling)
+    elif args.command == 'workers':
+        results = worker_pool_report(args.model, args.workers, args.concurrency, args.requests_per_thread)
+    elif args.command == 'resampling':
+        results = resampling_report(args.evi_dir, tuple(args.target_shape), args.methods, args.repeats)
+    else:
+        yield_data_weekly = pd.read_csv(args.yield_data, index_col='Date')
+        yield_data_weekly.index = pd.to_datetime(yield_data_weekly.index)
+        if args.command == 'bf16':
+            results = bf16_report(args.model, args.evi_dir, yield_data_weekly, args.repeats, args.max_relative_error)
+        else:
+            results = quantization_report(args.model, args.evi_dir, yield_data_weekly, args.repeats)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
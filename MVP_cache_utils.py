@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+
+# Default location for preprocessed EVI arrays
+EVI_CACHE_DIR = './evi_cache'
+# Default location for memoized forecasts
+PREDICTION_CACHE_DIR = './prediction_cache'
+
+# (path, size, mtime) -> content hash, so unchanged files are only hashed once per process
+_file_hash_memo = {}
+
+
+# Function to hash a file's contents
+def file_sha256(file_path):
+    stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hash_memo:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        _file_hash_memo[memo_key] = digest.hexdigest()
+    return _file_hash_memo[memo_key]
+
+
+# Function to build a cache key from anything with a stable repr (hashes, shapes, floats, strings)
+def make_cache_key(*parts):
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+# Function to memory-map a cached array, returns None on a miss
+def load_cached_array(cache_dir, key):
+    path = os.path.join(cache_dir, key + '.npy')
+    if not os.path.exists(path):
+        return None
+    try:
+        return np.load(path, mmap_mode='r')
+    except (ValueError, OSError):
+        # Truncated or corrupt entry, treat it as a miss so it gets rewritten
+        return None
+
+
+# Function to write a file under a temporary name and rename it into place, so concurrent readers never see a
+# partial entry
+def _atomic_write(cache_dir, file_name, write):
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, os.path.join(cache_dir, file_name))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+# Function to write an array to the cache
+def save_cached_array(cache_dir, key, array):
+    _atomic_write(cache_dir, key + '.npy', lambda f: np.save(f, np.ascontiguousarray(array)))
+
+
+# Disk-backed cache of forecast results. Entries are small JSON files, so every session (and every app
+# process) pointing at the same directory shares them, and they survive restarts.
+class PredictionCache:
+    def __init__(self, cache_dir=PREDICTION_CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    # Key for a forecast: the content hashes of the input scenes, the start date, a model version string
+    # (checkpoint checksum plus anything that changes its output) and the horizon in weeks
+    def key(self, scene_hashes, start_date, model_version, horizon, *extra):
+        return make_cache_key('prediction', tuple(sorted(scene_hashes)), str(start_date), model_version, horizon, *extra)
+
+    def get(self, key):
+        path = os.path.join(self.cache_dir, key + '.json')
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (ValueError, OSError):
+            return None
+
+    def put(self, key, value):
+        _atomic_write(self.cache_dir, key + '.json', lambda f: f.write(json.dumps(value).encode('utf-8')))
+
+
+# Single-flight layer: while a computation for a key is running, later calls with the same key wait for its
+# result instead of starting their own. Counters: hits (answered by the lookup, e.g. a PredictionCache entry),
+# misses (ran the computation) and coalesced (waited on a computation another caller had in flight).
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    # Return lookup() when it is not None, otherwise the result of compute(), shared with every concurrent
+    # call for the same key. Exceptions from compute() are raised in all of the waiting callers too.
+    def do(self, key, compute, lookup=None):
+        if lookup is not None:
+            value = lookup()
+            if value is not None:
+                with self.lock:
+                    self.hits += 1
+                return value
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+        try:
+            # The previous leader may have stored its result between our lookup and taking the lock
+            value = lookup() if lookup is not None else None
+            with self.lock:
+                if value is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            if value is None:
+                value = compute()
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced, 'in_flight': len(self.in_flight)}
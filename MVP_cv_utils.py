@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import psutil
+import torch
+import torch.nn as nn
+from sklearn.metrics import mean_absolute_error, mean_squared_error, median_absolute_error, r2_score
+from sklearn.model_selection import TimeSeriesSplit
+from torch.utils.data import DataLoader, Subset
+
+from MVP_cache_utils import file_sha256
+from MVP_inference_utils import augment_collate, build_frame_store, save_normalization_stats, spawn_context, train_and_evaluate, yield_data_version
+from MVP_model_utils import CNNFeatureExtractor, HybridModel
+
+METRICS = ['mse', 'rmse', 'mae', 'medae', 'r2']
+
+# Peak memory of one fold's training process: about 4.6 GB RSS measured for the per-pixel model at 512x512 and
+# batch 4, rounded up. The default number of concurrent folds is limited by it.
+FOLD_MEMORY_BYTES = 5 * 2**30
+
+
+# Function to pick how many folds run at once by default: one per core, as many as fit in the available memory
+# at FOLD_MEMORY_BYTES each, and always at least one
+def default_parallel_folds(n_folds, cores, fold_memory_bytes=FOLD_MEMORY_BYTES):
+    return max(1, min(n_folds, cores, int(psutil.virtual_memory().available // fold_memory_bytes)))
+
+
+# Function to score aggregated predictions against the labels, one value per sample
+def regression_metrics(labels, predictions):
+    mse = mean_squared_error(labels, predictions)
+    return {
+        'mse': float(mse),
+        'rmse': float(np.sqrt(mse)),
+        'mae': float(mean_absolute_error(labels, predictions)),
+        'medae': float(median_absolute_error(labels, predictions)),
+        'r2': float(r2_score(labels, predictions)) if len(labels) > 1 else float('nan'),
+    }
+
+
+# Function to collect (predictions, labels) over a loader. Per-pixel maps are reduced to their mean, the value a
+# scalar_target model predicts directly, so both kinds of model are scored on the same aggregated prediction.
+def predict_fold(model, loader, device='cpu'):
+    model.eval()
+    predictions, labels = [], []
+    with torch.no_grad():
+        for inputs, batch_labels, time_features in loader:
+            outputs = model(inputs.to(device), time_features.to(device))
+            predictions.append(outputs.reshape(len(outputs), -1).mean(dim=1).cpu().numpy())
+            labels.append(batch_labels.numpy())
+    return np.concatenate(predictions), np.concatenate(labels)
+
+
+# Function to write a file under a temporary name and rename it into place, so an interrupted run never leaves a
+# partial fold result behind
+def _write_atomic(path, write):
+    tmp_path = path + '.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _write_json(path, value):
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(value, f, indent=2)
+    _write_atomic(path, write)
+
+
+def fold_result_path(run_dir, fold):
+    return os.path.join(run_dir, f'fold_{fold}.json')
+
+
+# Function to train and score one fold in a worker process. The dataset is a FrameStore, so the worker maps the
+# shared frames file instead of receiving a copy. torch is limited to settings['threads'] threads so concurrent
+# folds split the cores instead of oversubscribing them. Writes fold_<k>.pt, its normalization stats
+# (see save_normalization_stats) and fold_<k>.json to run_dir.
+def run_fold(fold, dataset, train_index, val_index, settings, run_dir):
+    torch.set_num_threads(settings['threads'])
+    torch.manual_seed(settings['seed'] + fold)
+    train_loader = DataLoader(Subset(dataset, train_index), batch_size=settings['batch_size'], shuffle=True,
+                              collate_fn=augment_collate if settings['augment'] else None)
+    val_loader = DataLoader(Subset(dataset, val_index), batch_size=settings['batch_size'], shuffle=False)
+
+    model = HybridModel(CNNFeatureExtractor(settings['target_shape']), scalar_target=settings['scalar_target'])
+    optimizer = torch.optim.Adam(model.parameters(), lr=settings['learning_rate'], weight_decay=settings['weight_decay'])
+    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, patience=2)
+    best_loss = train_and_evaluate(model, train_loader, val_loader, optimizer, scheduler, nn.MSELoss(), settings['epochs'], 'cpu')
+
+    predictions, labels = predict_fold(model, val_loader)
+    result = {
+        'fold': fold,
+        'train_size': len(train_index),
+        'val_size': len(val_index),
+        'best_val_loss': float(best_loss),
+        **regression_metrics(labels, predictions),
+    }
+    model_path = os.path.join(run_dir, f'fold_{fold}.pt')
+    _write_atomic(model_path, lambda path: torch.save(model.state_dict(), path))
+    save_normalization_stats(model_path, settings['mean'], settings['std'], settings['target_shape'])
+    _write_json(fold_result_path(run_dir, fold), result)
+    return result
+
+
+# Function to combine fold results into one report: every fold's metrics plus their mean and std across folds
+def summarize_folds(results):
+    results = sorted(results, key=lambda result: result['fold'])
+    return {
+        'folds': results,
+        'mean': {metric: float(np.mean([result[metric] for result in results])) for metric in METRICS},
+        'std': {metric: float(np.std([result[metric] for result in results])) for metric in METRICS},
+    }
+
+
+def print_report(report):
+    print(f"{'fold':>6}" + ''.join(f"{metric:>12}" for metric in METRICS))
+    for result in report['folds']:
+        print(f"{result['fold'] + 1:>6}" + ''.join(f"{result[metric]:>12.4g}" for metric in METRICS))
+    for name in ('mean', 'std'):
+        print(f"{name:>6}" + ''.join(f"{report[name][metric]:>12.4g}" for metric in METRICS))
+
+
+# Function to run TimeSeriesSplit cross-validation of HybridModel on the scenes in evi_data_dir.
+# The FrameStore is built once in run_dir and every fold trains against it in its own process, n_parallel folds at
+# a time, each with an equal share of the cores as its torch thread budget. Each fold holds its own model and
+# activations (see FOLD_MEMORY_BYTES), so by default n_parallel is also limited by the available memory.
+# Finished folds are saved to run_dir and skipped when the run is started again with the same settings and data,
+# so an interrupted run resumes where it stopped.
+# Returns the summarize_folds report, also written to run_dir/report.json.
+def cross_validate(evi_data_dir, yield_data_weekly, run_dir, target_shape=(512, 512), n_splits=5, n_parallel=None, epochs=50,
+                   batch_size=4, learning_rate=0.001, weight_decay=0.0001, scalar_target=False, augment=False, seed=0, n_workers=None):
+    os.makedirs(run_dir, exist_ok=True)
+    scene_paths = sorted(os.path.join(evi_data_dir, file) for file in os.listdir(evi_data_dir) if file.endswith('.tiff'))
+    settings = {
+        'target_shape': list(target_shape),
+        'n_splits': n_splits,
+        'epochs': epochs,
+        'batch_size': batch_size,
+        'learning_rate': learning_rate,
+        'weight_decay': weight_decay,
+        'scalar_target': scalar_target,
+        'augment': augment,
+        'seed': seed,
+        'scenes': [file_sha256(scene_path) for scene_path in scene_paths],
+        'yield_data': yield_data_version(yield_data_weekly),
+    }
+    settings_path = os.path.join(run_dir, 'settings.json')
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            saved_settings = json.load(f)
+        if saved_settings != settings:
+            changed = sorted(key for key in settings if saved_settings.get(key) != settings[key])
+            raise ValueError(f"{run_dir} holds a run with different {', '.join(changed)}, use a new run directory")
+    else:
+        _write_json(settings_path, settings)
+
+    results = {}
+    for fold in range(n_splits):
+        if os.path.exists(fold_result_path(run_dir, fold)):
+            with open(fold_result_path(run_dir, fold)) as f:
+                results[fold] = json.load(f)
+    if results:
+        print(f"Resuming: folds {', '.join(str(fold + 1) for fold in sorted(results))} already done")
+
+    if len(results) < n_splits:
+        dataset, mean, std = build_frame_store(evi_data_dir, yield_data_weekly, target_shape, os.path.join(run_dir, 'frames.npy'), n_workers)
+        splits = list(TimeSeriesSplit(n_splits=n_splits).split(np.arange(len(dataset))))
+        pending = [fold for fold in range(n_splits) if fold not in results]
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+        n_parallel = min(n_parallel, len(pending)) if n_parallel else default_parallel_folds(len(pending), cores)
+        fold_settings = {**settings, 'threads': max(1, cores // n_parallel), 'mean': float(mean), 'std': float(std)}
+        print(f"Running {len(pending)} folds, {n_parallel} at a time with {fold_settings['threads']} threads each")
+
+        with ProcessPoolExecutor(n_parallel, mp_context=spawn_context()) as executor:
+            futures = {executor.submit(run_fold, fold, dataset, splits[fold][0], splits[fold][1], fold_settings, run_dir): fold
+                       for fold in pending}
+            for future in as_completed(futures):
+                result = future.result()
+                results[result['fold']] = result
+                print(f"Fold {result['fold'] + 1}/{n_splits} done: RMSE {result['rmse']:.4g}, R2 {result['r2']:.4g}")
+
+    report = summarize_folds(results.values())
+    _write_json(os.path.join(run_dir, 'report.json'), report)
+    print_report(report)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel, resumable TimeSeriesSplit cross-validation of the yield model")
+    parser.add_argument('--evi-dir', default='./latest_masked_evi')
+    parser.add_argument('--yield-data', default='yield_data_weekly.csv')
+    parser.add_argument('--run-dir', default='./cv_runs/default', help="Fold results go here; rerun with the same directory to resume")
+    parser.add_argument('--target-shape', nargs=2, type=int, default=[512, 512])
+    parser.add_argument('--n-splits', type=int, default=5)
+    parser.add_argument('--parallel', type=int, default=None,
+                        help=f"Folds run at once. Each needs about {FOLD_MEMORY_BYTES // 2**30} GB at 512x512 and batch 4, "
+                             "the default is one per core within the available memory")
+    parser.add_argument('--epochs', type=int, default=50)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--learning-rate', type=float, default=0.001)
+    parser.add_argument('--weight-decay', type=float, default=0.0001)
+    parser.add_argument('--scalar-target', action='store_true', help="Train the compact scalar head (see HybridModel)")
+    parser.add_argument('--augment', action='store_true', help="Augment training batches on the fly (see augment_batch)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--loader-workers', type=int, default=None, help="Scene loading processes (see load_training_scenes)")
+    args = parser.parse_args()
+
+    yield_data_weekly = pd.read_csv(args.yield_data, index_col='Date')
+    yield_data_weekly.index = pd.to_datetime(yield_data_weekly.index)
+    cross_validate(args.evi_dir, yield_data_weekly, args.run_dir, tuple(args.target_shape), args.n_splits, args.parallel, args.epochs,
+                   args.batch_size, args.learning_rate, args.weight_decay, args.scalar_target, args.augment, args.seed, args.loader_workers)
+
+
+if __name__ == '__main__':
+    main()
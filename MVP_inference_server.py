@@ -0,0 +1,386 @@
+import argparse
+import itertools
+import os
+import queue
+import secrets
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import AuthenticationError, Client, Listener
+
+import numpy as np
+
+DEFAULT_ADDRESS = ('localhost', 6006)
+# Requests are pickled, so the auth key is what keeps other local processes from running code in the server.
+# Clients and the server share it through this environment variable; it has no default.
+AUTHKEY_ENV = 'AGRISENSE_INFERENCE_AUTHKEY'
+# Pending connections the listener queues while the accept loop starts handler threads
+DEFAULT_BACKLOG = 64
+
+
+# Function to read the shared auth key from AGRISENSE_INFERENCE_AUTHKEY, returns None when it is not set
+def authkey_from_env():
+    authkey = os.environ.get(AUTHKEY_ENV)
+    return authkey.encode('utf-8') if authkey else None
+
+
+# Function to run a model following MVP_inference_utils.run_model without importing torch for other backends:
+# a model can only be a torch module if torch is already loaded, so serving ONNX keeps torch out of the process
+def run_model(model, evi_sequences, time_features, frame_index, device):
+    torch = sys.modules.get('torch')
+    if torch is None or not isinstance(model, torch.nn.Module):
+        return np.asarray(model(evi_sequences, time_features, frame_index))
+    from MVP_inference_utils import run_model as run_torch_model
+    return run_torch_model(model, evi_sequences, time_features, frame_index, device)
+
+
+# Queues (evi_sequences, time_features, frame_index) requests and runs the ones that arrive within
+# max_wait_ms of each other as one batched forward pass, up to max_batch_size EVI sequences per pass.
+# A single worker thread owns the model, so concurrent callers never contend for torch threads.
+class MicroBatcher:
+    def __init__(self, model, max_batch_size=16, max_wait_ms=5, device='cpu'):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.device = device
+        self.requests = queue.Queue()
+        self.batches_run = 0
+        self.requests_run = 0
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    # Arguments follow run_model: evi_sequences (sequences, time_steps, 1, H, W), time_features (rows, n_features)
+    # and frame_index (rows,) picking a sequence for each row. Returns a Future with the model output rows.
+    # Malformed requests are rejected here, so they never reach a batch shared with other callers.
+    def submit(self, evi_sequences, time_features, frame_index=None):
+        evi_sequences = np.asarray(evi_sequences, dtype=np.float32)
+        time_features = np.asarray(time_features, dtype=np.float32)
+        if frame_index is None:
+            frame_index = np.arange(len(evi_sequences))
+        frame_index = np.asarray(frame_index, dtype=np.int64)
+        if evi_sequences.ndim != 5:
+            raise ValueError(f"evi_sequences must be (sequences, time_steps, 1, H, W), got shape {evi_sequences.shape}")
+        if time_features.ndim != 2 or frame_index.shape != (len(time_features),):
+            raise ValueError(f"time_features must be (rows, n_features) with one frame_index per row, got {time_features.shape} and {frame_index.shape}")
+        if len(frame_index) and (frame_index.min() < 0 or frame_index.max() >= len(evi_sequences)):
+            raise ValueError(f"frame_index must be in [0, {len(evi_sequences)}), got [{frame_index.min()}, {frame_index.max()}]")
+        future = Future()
+        self.requests.put((evi_sequences, time_features, frame_index, future))
+        return future
+
+    def __call__(self, evi_sequences, time_features, frame_index=None):
+        return self.submit(evi_sequences, time_features, frame_index).result()
+
+    # Collect requests until the batch is full or max_wait has passed since the first one arrived
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        n_sequences = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while n_sequences < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_sequences += len(request[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            # Sequences of different lengths or frame sizes, or rows with a different number of time features,
+            # cannot be stacked, run each shape as its own pass
+            groups = {}
+            for request in batch:
+                groups.setdefault((request[0].shape[1:], request[1].shape[1]), []).append(request)
+            for requests in groups.values():
+                self._run_group(requests)
+            self.batches_run += 1
+            self.requests_run += len(batch)
+
+    def _run_group(self, requests):
+        offsets = np.cumsum([0] + [len(request[0]) for request in requests])
+        try:
+            outputs = run_model(
+                self.model,
+                np.concatenate([request[0] for request in requests]),
+                np.concatenate([request[1] for request in requests]),
+                np.concatenate([request[2] + offset for request, offset in zip(requests, offsets)]),
+                self.device,
+            )
+        except Exception as e:
+            if len(requests) > 1:
+                # Rerun each request on its own so only the one that caused the failure gets the error
+                for request in requests:
+                    self._run_group([request])
+                return
+            requests[0][3].set_exception(e)
+            return
+        start = 0
+        for request in requests:
+            request[3].set_result(outputs[start:start + len(request[1])])
+            start += len(request[1])
+
+
+# Function to serve a model over a local socket. Each connection gets its own thread; all of them feed one
+# MicroBatcher. Runs until interrupted. Without an authkey (argument or AGRISENSE_INFERENCE_AUTHKEY) a random one
+# is generated and printed for the clients. backlog should cover the number of clients expected to connect at once.
+# model_version identifies the served model (see model_identity), clients fetch it to key their forecast caches.
+def serve(model, address=DEFAULT_ADDRESS, authkey=None, max_batch_size=16, max_wait_ms=5, device='cpu', backlog=DEFAULT_BACKLOG,
+          model_version=None):
+    authkey = authkey or authkey_from_env()
+    if authkey is None:
+        authkey = secrets.token_hex(32).encode('utf-8')
+        print(f"No {AUTHKEY_ENV} set, clients must use: {AUTHKEY_ENV}={authkey.decode('utf-8')}")
+    batcher = MicroBatcher(model, max_batch_size, max_wait_ms, device)
+
+    def handle(conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    return
+                if request == 'model_version':
+                    conn.send(('ok', model_version) if model_version is not None else ('error', "The server was started without a model version"))
+                    continue
+                try:
+                    conn.send(('ok', batcher(*request)))
+                except Exception as e:
+                    conn.send(('error', f"{type(e).__name__}: {e}"))
+
+    with Listener(address, backlog=backlog, authkey=authkey) as listener:
+        print(f"Inference server listening on {address[0]}:{address[1]} (max batch {max_batch_size}, max wait {max_wait_ms} ms)")
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, OSError) as e:
+                # A client with the wrong key or a dropped handshake only loses its own connection
+                print(f"Rejected connection: {type(e).__name__}: {e}")
+                continue
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+# Thin client for the inference server. It follows the backend interface used by run_model, so it can be
+# passed as the model to predict / predict_batch / predict_weekly_yield. Each thread gets its own connection
+# so concurrent Streamlit sessions can be batched together on the server.
+class InferenceClient:
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None):
+        self.address = address
+        self.authkey = authkey or authkey_from_env()
+        if self.authkey is None:
+            raise ValueError(f"Set {AUTHKEY_ENV} to the inference server's auth key")
+        self._local = threading.local()
+
+    def _connection(self):
+        if getattr(self._local, 'conn', None) is None:
+            self._local.conn = Client(self.address, authkey=self.authkey)
+        return self._local.conn
+
+    def __call__(self, evi_sequences, time_features, frame_index=None):
+        if frame_index is None:
+            frame_index = np.arange(len(evi_sequences))
+        return self._request((np.asarray(evi_sequences, dtype=np.float32), np.asarray(time_features, dtype=np.float32), np.asarray(frame_index, dtype=np.int64)))
+
+    # The identity of the model the server is running (see model_identity), which may differ from local checkpoints
+    def model_version(self):
+        return self._request('model_version')
+
+    def _request(self, request):
+        conn = self._connection()
+        try:
+            conn.send(request)
+            status, result = conn.recv()
+        except (EOFError, OSError):
+            # Server restarted or connection dropped, reconnect on the next call
+            self._local.conn = None
+            raise
+        if status != 'ok':
+            raise RuntimeError(f"Inference server error: {result}")
+        return result
+
+
+# Function to split the cores this process may run on into n_workers contiguous subsets
+def partition_cores(n_workers=None):
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    n_workers = min(n_workers or len(cores), len(cores))
+    return [[int(core) for core in subset] for subset in np.array_split(cores, n_workers)]
+
+
+# Worker process loop for WorkerPool: pin to its cores, size torch's thread pool to match, load the model once
+# and then run requests until it gets None
+def _pool_worker(model_path, cores, total_yield, quantize, tasks, results):
+    import torch
+    from MVP_model_utils import load_model
+
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+    model = load_model(model_path, total_yield=total_yield, quantize=quantize)
+    results.put(('ready', None, None))
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task_id, evi_sequences, time_features, frame_index = task
+        try:
+            results.put((task_id, 'ok', run_model(model, evi_sequences, time_features, frame_index, 'cpu')))
+        except Exception as e:
+            results.put((task_id, 'error', f"{type(e).__name__}: {e}"))
+
+
+# Pool of inference worker processes started up front, each pinned to its own subset of cores with
+# torch.set_num_threads matching the subset, so one heavy request cannot take every core while other sessions wait.
+# Every worker loads the model once at startup; the weights are memory-mapped (see load_model), so all workers share
+# one copy through the page cache. Requests go to whichever worker is free. If a worker dies (e.g. killed for
+# running out of memory) every outstanding request fails and the pool refuses new ones.
+# It follows the backend interface used by run_model, so it can be passed as the model to predict /
+# predict_batch / predict_weekly_yield from any number of threads.
+class WorkerPool:
+    def __init__(self, model_path, n_workers=None, total_yield=True, quantize=False):
+        from MVP_inference_utils import spawn_context
+
+        context = spawn_context()
+        self.core_sets = partition_cores(n_workers)
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.workers = [context.Process(target=_pool_worker, args=(model_path, cores, total_yield, quantize, self.tasks, self.results), daemon=True)
+                        for cores in self.core_sets]
+        for worker in self.workers:
+            worker.start()
+        for _ in self.workers:
+            self._wait_ready()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        self.failure = None
+        self.task_ids = itertools.count()
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+
+    def _wait_ready(self):
+        while True:
+            try:
+                self.results.get(timeout=1)
+                return
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    self.close()
+                    raise RuntimeError("An inference worker exited during startup")
+
+    def _collect(self):
+        while True:
+            try:
+                task_id, status, result = self.results.get(timeout=1)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            except Exception:
+                # A worker killed mid-write leaves a truncated message on the queue
+                self._check_workers()
+                if self.failure is not None or self.closed:
+                    return
+                raise
+            if task_id is None:
+                return
+            with self.lock:
+                future = self.pending.pop(task_id, None)
+            if future is None:
+                continue
+            if status == 'ok':
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(f"Inference worker error: {result}"))
+
+    # A dead worker takes its request with it and the queue cannot tell which one that was, so fail them all
+    def _check_workers(self):
+        dead = [worker for worker in self.workers if not worker.is_alive()]
+        if not dead or self.closed:
+            return
+        with self.lock:
+            self.failure = f"Inference worker exited with code {dead[0].exitcode}"
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(RuntimeError(self.failure))
+
+    # Arguments follow run_model. Returns a Future with the model output rows.
+    def submit(self, evi_sequences, time_features, frame_index=None):
+        if frame_index is None:
+            frame_index = np.arange(len(evi_sequences))
+        future = Future()
+        task_id = next(self.task_ids)
+        with self.lock:
+            if self.failure is not None:
+                raise RuntimeError(self.failure)
+            self.pending[task_id] = future
+        self.tasks.put((task_id, np.asarray(evi_sequences, dtype=np.float32), np.asarray(time_features, dtype=np.float32),
+                        np.asarray(frame_index, dtype=np.int64)))
+        return future
+
+    def __call__(self, evi_sequences, time_features, frame_index=None):
+        return self.submit(evi_sequences, time_features, frame_index).result()
+
+    def close(self):
+        self.closed = True
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        if getattr(self, 'collector', None) is not None:
+            self.results.put((None, None, None))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Function to identify a served model: the checksum of the checkpoint (or ONNX file) plus the options that change
+# its output
+def model_identity(model_path, onnx_path=None, quantize=False):
+    from MVP_cache_utils import file_sha256, make_cache_key
+
+    return make_cache_key(file_sha256(onnx_path or model_path), 'total_yield', 'onnx' if onnx_path else '', 'int8' if quantize else '')
+
+
+# Function to parse a "host:port" address
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def main():
+    from MVP_model_utils import load_model
+
+    parser = argparse.ArgumentParser(description="Local yield model inference server with request micro-batching")
+    parser.add_argument('--model', default='trained-full-dataset.pt')
+    parser.add_argument('--address', default=f"{DEFAULT_ADDRESS[0]}:{DEFAULT_ADDRESS[1]}", help="host:port to listen on")
+    parser.add_argument('--max-batch-size', type=int, default=16, help="Most EVI sequences run in one forward pass")
+    parser.add_argument('--max-wait-ms', type=float, default=5, help="How long to wait for more requests after the first one")
+    parser.add_argument('--quantize', action='store_true', help="Serve the dynamic int8 model")
+    parser.add_argument('--onnx', default=None, help="Serve an export_onnx file with ONNX Runtime instead of PyTorch")
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG, help="Connections queued while earlier ones are accepted")
+    args = parser.parse_args()
+
+    if args.onnx:
+        from MVP_onnx_utils import OnnxYieldModel
+        model = OnnxYieldModel(args.onnx)
+    else:
+        model = load_model(args.model, total_yield=True, quantize=args.quantize)
+    serve(model, parse_address(args.address), max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms, backlog=args.backlog,
+          model_version=model_identity(args.model, args.onnx, args.quantize and not args.onnx))
+
+
+if __name__ == '__main__':
+    main()
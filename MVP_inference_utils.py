@@ -1,4 +1,10 @@
+import json
+import multiprocessing
 import os
+import tempfile
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import timedelta
 
 import numpy as np
@@ -8,19 +14,82 @@ import torch.nn.functional as F
 from skimage.draw import polygon
 from skimage.transform import resize, rotate
 from sklearn.model_selection import train_test_split
-from torch.utils.data import DataLoader, Dataset, Subset
+from torch.utils.data import DataLoader, Dataset, Subset, default_collate
 from tqdm import tqdm
-from MVP_utils import load_evi_data
+from MVP_utils import load_evi_data, load_evi_data_decimated
+from MVP_model_utils import cpu_supports_bf16, to_bfloat16
+from MVP_cache_utils import EVI_CACHE_DIR, file_sha256, make_cache_key, load_cached_array, save_cached_array
 
 METERS_PER_SQR_PX = 30 # 30m^2 per pixel
 
 target_shape = (512, 512)
 
+# Resampling used to bring scenes to target_shape at inference: a rasterio Resampling name for decimated reads
+# (see MVP_utils.load_evi_data_decimated), or None for the full read + skimage resize used in training
+EVI_RESAMPLING = 'bilinear'
+
+# Time features fed to the model alongside each EVI sequence, in model input order
+TIME_FEATURE_COLUMNS = ['month_sin', 'month_cos', 'day_of_year_sin', 'day_of_year_cos', 'Volume (Pounds)', 'Cumulative Volumne (Pounds)']
+
+# Function to get the multiprocessing context for worker processes. Workers are spawned rather than forked:
+# forking a process that already ran torch ops can deadlock OpenMP.
+def spawn_context():
+    return multiprocessing.get_context('spawn')
+
 # Function to preprocess and normalize EVI data
 def preprocess_image(image, target_shape, mean, std):
-    image_resized = resize(image, target_shape, anti_aliasing=True)
+    # resize() to the shape the image already has is an identity, so skip it
+    image_resized = image if image.shape == tuple(target_shape) else resize(image, target_shape, anti_aliasing=True)
     return (image_resized - mean) / std
 
+# Function to read an EVI raster at target_shape as float32, either decimated by rasterio or with the
+# full read + skimage resize when resampling is None
+def read_resized_evi_data(file_path, target_shape, resampling=EVI_RESAMPLING):
+    if resampling is None:
+        return resize(load_evi_data(file_path), target_shape, anti_aliasing=True).astype(np.float32)
+    return load_evi_data_decimated(file_path, target_shape, resampling)
+
+# Function to load an EVI raster resized to target_shape as float32, reusing the on-disk cache
+# (keyed by file content, so a changed scene is picked up automatically)
+def load_resized_evi_data(file_path, target_shape, cache_dir=EVI_CACHE_DIR, resampling=EVI_RESAMPLING):
+    if cache_dir is None:
+        return read_resized_evi_data(file_path, target_shape, resampling)
+    key = make_cache_key('resized', file_sha256(file_path), tuple(target_shape), resampling)
+    evi_data = load_cached_array(cache_dir, key)
+    if evi_data is None:
+        evi_data = read_resized_evi_data(file_path, target_shape, resampling)
+        save_cached_array(cache_dir, key, evi_data)
+    return evi_data
+
+# Function to load a resized EVI raster normalized with mean/std as float32, reusing the on-disk cache
+def load_preprocessed_evi_data(file_path, target_shape, mean, std, cache_dir=EVI_CACHE_DIR, resampling=EVI_RESAMPLING):
+    if cache_dir is None:
+        return preprocess_image(load_resized_evi_data(file_path, target_shape, None, resampling), target_shape, mean, std).astype(np.float32)
+    key = make_cache_key('normalized', file_sha256(file_path), tuple(target_shape), float(mean), float(std), resampling)
+    evi_data = load_cached_array(cache_dir, key)
+    if evi_data is None:
+        evi_data = preprocess_image(load_resized_evi_data(file_path, target_shape, cache_dir, resampling), target_shape, mean, std).astype(np.float32)
+        save_cached_array(cache_dir, key, evi_data)
+    return evi_data
+
+# Function to compare decimated reads against the full read + skimage resize path on a set of scenes.
+# Returns the mean absolute difference relative to the mean absolute reference value, the largest absolute
+# difference and the lowest per-scene correlation.
+def check_resampling_fidelity(file_paths, target_shape, resampling=EVI_RESAMPLING):
+    relative_errors, max_errors, correlations = [], [], []
+    for file_path in file_paths:
+        expected = read_resized_evi_data(file_path, target_shape, None)
+        actual = read_resized_evi_data(file_path, target_shape, resampling)
+        difference = np.abs(actual - expected)
+        relative_errors.append(difference.mean() / max(np.abs(expected).mean(), 1e-12))
+        max_errors.append(difference.max())
+        correlations.append(np.corrcoef(actual.ravel(), expected.ravel())[0, 1])
+    return {
+        'mean_abs_relative': float(np.mean(relative_errors)),
+        'max_abs': float(np.max(max_errors)),
+        'min_correlation': float(np.min(correlations)),
+    }
+
 def augment_image(image):
     # Apply random horizontal and vertical flips
     if np.random.rand() > 0.5:
@@ -35,6 +104,37 @@ def augment_image(image):
     image = resize(image, (int(image.shape[0] * zoom_factor), int(image.shape[1] * zoom_factor)), anti_aliasing=True)
     return image
 
+# Function to augment a batch of EVI sequences (batch, time_steps, 1, H, W) with random flips, rotations within
+# +-max_angle degrees and zooms in zoom_range about the centre, drawn per sequence and applied with a single
+# affine_grid / grid_sample call. Every frame of a sequence gets the same transform, so the field stays aligned
+# across time. Edges are filled by reflection, like augment_image's rotate(mode='reflect').
+def augment_batch(evi_sequences, max_angle=45.0, zoom_range=(0.8, 1.2), generator=None):
+    batch_size, time_steps, channels, height, width = evi_sequences.shape
+    angles = torch.deg2rad((torch.rand(batch_size, generator=generator) * 2 - 1) * max_angle)
+    zooms = torch.empty(batch_size).uniform_(*zoom_range, generator=generator)
+    flip_cols = torch.where(torch.rand(batch_size, generator=generator) < 0.5, -1.0, 1.0)
+    flip_rows = torch.where(torch.rand(batch_size, generator=generator) < 0.5, -1.0, 1.0)
+    cos, sin = torch.cos(angles) / zooms, torch.sin(angles) / zooms
+
+    # Maps output to input positions in affine_grid's normalized coordinates; the off-diagonal terms are scaled by
+    # the aspect ratio so the rotation is rigid in pixels on non-square frames
+    theta = torch.zeros(batch_size, 2, 3)
+    theta[:, 0, 0] = cos * flip_cols
+    theta[:, 0, 1] = -sin * flip_rows * height / width
+    theta[:, 1, 0] = sin * flip_cols * width / height
+    theta[:, 1, 1] = cos * flip_rows
+
+    # Time steps ride along as channels, so one grid warps the whole sequence
+    frames = evi_sequences.reshape(batch_size, time_steps * channels, height, width).float()
+    grid = F.affine_grid(theta, frames.shape, align_corners=False)
+    augmented = F.grid_sample(frames, grid, mode='bilinear', padding_mode='reflection', align_corners=False)
+    return augmented.reshape(evi_sequences.shape).to(evi_sequences.dtype)
+
+# DataLoader collate_fn that stacks the samples and augments the EVI batch, so each epoch sees fresh augmentations
+def augment_collate(samples):
+    evi_sequences, labels, time_features = default_collate(samples)
+    return augment_batch(evi_sequences), labels, time_features
+
 # Function for unifying EVI and yield data
 class CustomDataset(Dataset):
     def __init__(self, evi_data_dict, evi_reference, yield_data, sequence_length=4):
@@ -50,63 +150,174 @@ class CustomDataset(Dataset):
         evi_sequence = [self.evi_data_dict[self.evi_reference[idx + i]] for i in range(self.sequence_length)]
         evi_sequence = torch.tensor(evi_sequence, dtype=torch.float32).unsqueeze(1)
         yield_val = self.yield_data.iloc[idx + self.sequence_length - 1]['Volume (Pounds)']
-        time_features = self.yield_data.iloc[idx + self.sequence_length - 1][['month_sin', 'month_cos', 'day_of_year_sin', 'day_of_year_cos', 'Volume (Pounds)', 'Cumulative Volumne (Pounds)']].values
+        time_features = self.yield_data.iloc[idx + self.sequence_length - 1][TIME_FEATURE_COLUMNS].values
         return evi_sequence, torch.tensor(yield_val, dtype=torch.float32), torch.tensor(time_features, dtype=torch.float32)
     
-def sync_evi_yield_data(evi_data_dict, yield_data_weekly):
-    evi_reference = []
-    evi_data_dict_combined = {}
+# Training data store serving the same samples as CustomDataset. Every distinct preprocessed frame is written
+# once into a contiguous float32 .npy memmap; labels, time features and the frame each week uses are aligned
+# NumPy arrays, so a sample is a slice of the memmap (a view when the sequence's frames are consecutive) plus
+# tensor views, with no per-sample pandas lookups. DataLoader workers reopen the file instead of receiving a
+# pickled copy, so they all share the frames through the page cache.
+class FrameStore(Dataset):
+    def __init__(self, frames_path, frame_index, labels, time_features, sequence_length=4):
+        self.frames_path = frames_path
+        self.frame_index = np.asarray(frame_index, dtype=np.int64)
+        self.labels = torch.from_numpy(np.asarray(labels, dtype=np.float32))
+        self.time_features = torch.from_numpy(np.asarray(time_features, dtype=np.float32))
+        self.sequence_length = sequence_length
+        self._frames = None
+
+    # Function to write the frames of evi_data_dict used by evi_reference (one date per yield_data row, see
+    # sync_evi_yield_data) to frames_path, in date order, and build the store over them
+    @classmethod
+    def build(cls, evi_data_dict, evi_reference, yield_data, frames_path, sequence_length=4):
+        dates = sorted(set(evi_reference))
+        positions = {date: position for position, date in enumerate(dates)}
+        first = np.asarray(evi_data_dict[dates[0]])
+        frames = np.lib.format.open_memmap(frames_path, mode='w+', dtype=np.float32, shape=(len(dates), *first.shape))
+        for position, date in enumerate(dates):
+            frames[position] = evi_data_dict[date]
+        frames.flush()
+        del frames
+        frame_index = [positions[date] for date in evi_reference]
+        return cls(frames_path, frame_index, yield_data['Volume (Pounds)'].values, yield_data[TIME_FEATURE_COLUMNS].values, sequence_length)
+
+    # Opened lazily, so each worker process maps the file itself. Copy-on-write keeps the arrays writable for
+    # torch.from_numpy without ever writing back to the file.
+    @property
+    def frames(self):
+        if self._frames is None:
+            self._frames = np.load(self.frames_path, mmap_mode='c')
+        return self._frames
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_frames'] = None
+        return state
+
+    def __len__(self):
+        return len(self.labels) - self.sequence_length + 1
+
+    def __getitem__(self, idx):
+        rows = self.frame_index[idx:idx + self.sequence_length]
+        if np.all(np.diff(rows) == 1):
+            evi_sequence = self.frames[rows[0]:rows[0] + self.sequence_length]
+        else:
+            # Weeks that share a scene repeat a frame, which a slice cannot express
+            evi_sequence = self.frames[rows]
+        last = idx + self.sequence_length - 1
+        return torch.from_numpy(evi_sequence).unsqueeze(1), self.labels[last], self.time_features[last]
 
-    for date in yield_data_weekly.index:
-        # Find the closest available EVI date for each yield date
-        closest_evi_date = find_closest_date(date, evi_data_dict)
-        evi_reference.append(closest_evi_date)
-        evi_data_dict_combined[closest_evi_date] = evi_data_dict[closest_evi_date]
+def sync_evi_yield_data(evi_data_dict, yield_data_weekly):
+    # Find the closest available EVI date for each yield date
+    evi_reference = list(DateIndex(evi_data_dict.keys()).nearest(yield_data_weekly.index))
+    evi_data_dict_combined = {date: evi_data_dict[date] for date in evi_reference}
 
     return evi_data_dict_combined, evi_reference
     
-def prepare_dataset(evi_data_dir, yield_data_weekly, target_shape, augment=False):
-    # Load EVI data
-    evi_data_dict = {}
-    evi_data_files = os.listdir(evi_data_dir)
-    for idx, file in enumerate(evi_data_files):
+# Function to read one training scene for load_training_scenes: load, resize to target_shape and accumulate its
+# normalization stats
+def _load_training_scene(file_path, target_shape):
+    evi_data = load_evi_data(file_path)
+    image = evi_data if evi_data.shape == tuple(target_shape) else resize(evi_data, target_shape, anti_aliasing=True)
+    stats = RunningStats()
+    stats.update(image)
+    return image.astype(np.float32), stats
+
+# Function to load every scene in evi_data_dir for training in a single pass per file (read, resize and
+# normalization stats), fanned out over n_workers processes (one per core by default, 1 runs in-process).
+# Prints progress and the scene throughput. Returns ({date: normalized float32 frame}, mean, std), the same
+# frames and stats as compute_mean_std + preprocess_image over the full reads.
+def load_training_scenes(evi_data_dir, target_shape, n_workers=None):
+    evi_file_paths = {}
+    for file in sorted(os.listdir(evi_data_dir)):
         if file.endswith('.tiff'):
-            print(f"Processing file {idx+1}/{len(evi_data_files)}", end='\r')
             date_str = os.path.basename(file).split('_')[3]
-            date = pd.to_datetime(date_str, format='%Y%m%d')
-            evi_data = load_evi_data(os.path.join(evi_data_dir, file))
-            if augment:
-                evi_data = augment_image(evi_data)
-            evi_data_dict[date] = evi_data
-
-    # Extract mean and std from the preprocessed data
-    mean, std = compute_mean_std(evi_data_dict, target_shape)
-
-    # Preprocess all images using the calculated mean and std
-    for date in evi_data_dict:
-        evi_data_dict[date] = preprocess_image(evi_data_dict[date], target_shape, mean, std)
+            evi_file_paths[pd.to_datetime(date_str, format='%Y%m%d')] = os.path.join(evi_data_dir, file)
+    dates = list(evi_file_paths)
+    n_workers = min(n_workers or os.cpu_count() or 1, max(len(dates), 1))
+
+    start = time.perf_counter()
+    def report(done):
+        elapsed = time.perf_counter() - start
+        print(f"Processing file {done}/{len(dates)} ({done / elapsed:.1f} scenes/s)", end='\r')
+
+    results = {}
+    if n_workers == 1:
+        for date in dates:
+            results[date] = _load_training_scene(evi_file_paths[date], target_shape)
+            report(len(results))
+    else:
+        with ProcessPoolExecutor(n_workers, mp_context=spawn_context()) as executor:
+            futures = {executor.submit(_load_training_scene, evi_file_paths[date], target_shape): date for date in dates}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                report(len(results))
+    elapsed = time.perf_counter() - start
+    print(f"Loaded {len(dates)} scenes in {elapsed:.1f}s ({len(dates) / max(elapsed, 1e-9):.1f} scenes/s, {n_workers} workers)")
+
+    # Merge in date order so the stats do not depend on completion order
+    stats = RunningStats()
+    for date in dates:
+        stats.merge(results[date][1])
+    mean, std = stats.mean, stats.std
+    evi_data_dict = {date: (results[date][0] - np.float32(mean)) / np.float32(std) for date in dates}
+    return evi_data_dict, mean, std
+
+# Function to load the scenes in evi_data_dir and build the training FrameStore over yield_data_weekly.
+# frames_path is where the frames go and the caller owns that file. Without one the frames go to a temporary file in
+# frame_store_dir (the system temp directory by default) that is deleted once the dataset is garbage collected or
+# the process exits. n_workers is the number of scene loading processes (see load_training_scenes).
+# Returns (dataset, mean, std).
+def build_frame_store(evi_data_dir, yield_data_weekly, target_shape, frames_path=None, n_workers=None, frame_store_dir=None):
+    # Load and preprocess EVI data
+    evi_data_dict, mean, std = load_training_scenes(evi_data_dir, target_shape, n_workers)
 
     # Prepare dataset with synchronized EVI and yield data
     evi_data_dict_combined, evi_reference_combined = sync_evi_yield_data(evi_data_dict, yield_data_weekly)
 
-    dataset = CustomDataset(evi_data_dict_combined, evi_reference_combined, yield_data_weekly)
+    if frames_path is not None:
+        return FrameStore.build(evi_data_dict_combined, evi_reference_combined, yield_data_weekly, frames_path), mean, std
+    fd, frames_path = tempfile.mkstemp(suffix='_frames.npy', dir=frame_store_dir)
+    os.close(fd)
+    try:
+        dataset = FrameStore.build(evi_data_dict_combined, evi_reference_combined, yield_data_weekly, frames_path)
+    except BaseException:
+        os.remove(frames_path)
+        raise
+    # Registered on this process's dataset only; copies unpickled in DataLoader workers leave the file alone
+    weakref.finalize(dataset, os.remove, frames_path)
+    return dataset, mean, std
+
+# augment applies augment_batch to every training batch (see augment_collate); frame_store_dir is where the
+# temporary FrameStore file goes (see build_frame_store), it is deleted along with the loaders;
+# n_workers is the number of scene loading processes (see load_training_scenes)
+def prepare_dataset(evi_data_dir, yield_data_weekly, target_shape, augment=False, frame_store_dir=None, n_workers=None):
+    dataset, mean, std = build_frame_store(evi_data_dir, yield_data_weekly, target_shape, None, n_workers, frame_store_dir)
     train_indices, test_indices = train_test_split(np.arange(len(dataset)), test_size=0.2, random_state=42)
 
     train_subset = torch.utils.data.Subset(dataset, train_indices)
     test_subset = torch.utils.data.Subset(dataset, test_indices)
 
-    train_loader = DataLoader(train_subset, batch_size=4, shuffle=True)
+    train_loader = DataLoader(train_subset, batch_size=4, shuffle=True, collate_fn=augment_collate if augment else None)
     test_loader = DataLoader(test_subset, batch_size=4, shuffle=False)
 
     return train_loader, test_loader, mean, std
 
+# Function to broadcast one label per sample to the model output: the per-pixel map, or a single value for a
+# scalar_target model. criterion is then the per-pixel loss or the loss on the aggregated (mean-pixel) prediction;
+# per-pixel MSE against a constant label is the mean-pixel MSE plus the spread of the map around its mean.
+def match_labels(outputs, labels):
+    return labels.view(-1, *[1] * (outputs.dim() - 1)).expand_as(outputs)
+
+# Works with per-pixel and scalar_target models (see HybridModel); use expand_to_per_pixel or load_model to get
+# the per-pixel head back from a scalar_target checkpoint
 def train_and_evaluate(model, train_loader, val_loader, optimizer, scheduler, criterion, epochs, device):
     print(f"# of samples - Training   - {len(train_loader.dataset)}")
     print(f"# of samples - Validation - {len(val_loader.dataset)}")
     best_loss = float('inf')
     patience = 5  # Increased patience to avoid premature stopping
     trigger_times = 0
-    target_shape = (512, 512)
     
     for epoch in range(epochs):
         running_loss = 0.0
@@ -115,7 +326,7 @@ def train_and_evaluate(model, train_loader, val_loader, optimizer, scheduler, cr
             inputs, labels, time_features = inputs.to(device), labels.to(device), time_features.to(device)
             optimizer.zero_grad()
             outputs = model(inputs, time_features)
-            labels = labels.unsqueeze(1).unsqueeze(2).expand(-1, target_shape[0], target_shape[1])
+            labels = match_labels(outputs, labels)
             loss = criterion(outputs, labels)
             loss.backward()
             optimizer.step()
@@ -131,7 +342,7 @@ def train_and_evaluate(model, train_loader, val_loader, optimizer, scheduler, cr
                     for inputs, labels, time_features in val_loader:
                         inputs, labels, time_features = inputs.to(device), labels.to(device), time_features.to(device)
                         outputs = model(inputs, time_features)
-                        labels = labels.unsqueeze(1).unsqueeze(2).expand(-1, target_shape[0], target_shape[1])
+                        labels = match_labels(outputs, labels)
                         loss = criterion(outputs, labels)
                         val_loss += loss.item()
         val_loss /= len(val_loader)
@@ -150,40 +361,90 @@ def train_and_evaluate(model, train_loader, val_loader, optimizer, scheduler, cr
 
     return best_loss
 
+# Streaming mean/variance accumulator (Welford, with Chan's pairwise merge), so normalization
+# stats can be built one image at a time and partial results from several workers combined
+class RunningStats:
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if values.size:
+            batch_mean = values.mean()
+            self._merge(values.size, batch_mean, np.square(values - batch_mean).sum())
+
+    def merge(self, other):
+        self._merge(other.count, other.mean, other.m2)
+
+    def _merge(self, count, mean, m2):
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    @property
+    def std(self):
+        # Population std, to match np.std
+        return np.sqrt(self.m2 / self.count) if self.count else 0.0
+
 # Fucntion to find the mean & standard deviation
 def compute_mean_std(evi_data_dict, target_shape):
-    all_images = np.array([resize(image, target_shape, anti_aliasing=True) for image in evi_data_dict.values()])
-    mean = np.mean(all_images)
-    std = np.std(all_images)
-    return mean, std
+    stats = RunningStats()
+    for image in evi_data_dict.values():
+        stats.update(image if image.shape == tuple(target_shape) else resize(image, target_shape, anti_aliasing=True))
+    return stats.mean, stats.std
+
+# Normalization stats are saved next to the model checkpoint, e.g. trained-full-dataset.pt -> trained-full-dataset_normalization.json
+def normalization_stats_path(model_path):
+    return os.path.splitext(model_path)[0] + '_normalization.json'
+
+# Function to freeze the training normalization stats alongside a checkpoint
+def save_normalization_stats(model_path, mean, std, target_shape):
+    with open(normalization_stats_path(model_path), 'w') as f:
+        json.dump({'mean': float(mean), 'std': float(std), 'target_shape': list(target_shape)}, f, indent=2)
+
+# Function to load the frozen normalization stats for a checkpoint, returns (None, None) when none were saved
+def load_normalization_stats(model_path, target_shape):
+    stats_path = normalization_stats_path(model_path)
+    if not os.path.exists(stats_path):
+        return None, None
+    with open(stats_path) as f:
+        stats = json.load(f)
+    if tuple(stats['target_shape']) != tuple(target_shape):
+        raise ValueError(f"Normalization stats in {stats_path} were computed for target_shape {tuple(stats['target_shape'])}, not {tuple(target_shape)}")
+    return stats['mean'], stats['std']
 
 # Load EVI data and prepare time features
-def load_evi_data_and_prepare_features(evi_data_dir, time_index, target_shape):
+# Pass the frozen training mean/std (see load_normalization_stats) to skip rescanning every scene
+def load_evi_data_and_prepare_features(evi_data_dir, time_index, target_shape, cache_dir=EVI_CACHE_DIR, mean=None, std=None, resampling=EVI_RESAMPLING):
     
-    evi_data_dict = {}
+    evi_file_paths = {}
     for file in os.listdir(evi_data_dir):
         if file.endswith('.tiff'):
             date_str = os.path.basename(file).split('_')[3]
             date = pd.to_datetime(date_str, format='%Y%m%d')
-            evi_data = load_evi_data(os.path.join(evi_data_dir, file))
-            #put debugging about evi_data shape here
-            print("data shape in dict:",evi_data.shape)
-            evi_data_dict[date] = evi_data
+            evi_file_paths[date] = os.path.join(evi_data_dir, file)
 
-    mean, std = compute_mean_std(evi_data_dict, target_shape)
+    if mean is None or std is None:
+        evi_data_dict = {date: load_resized_evi_data(file_path, target_shape, cache_dir, resampling) for date, file_path in evi_file_paths.items()}
+        mean, std = compute_mean_std(evi_data_dict, target_shape)
 
     # Prepare features
     evi_data_preprocessed_dict = {}
     time_features_list = []
     for date in time_index:
-        if date in evi_data_dict:
-            evi_data = evi_data_dict[date]
+        if date in evi_file_paths:
             month_sin = np.sin(2 * np.pi * date.month / 12)
             month_cos = np.cos(2 * np.pi * date.month / 12)
             day_of_year_sin = np.sin(2 * np.pi * date.day_of_year / 365)
             day_of_year_cos = np.cos(2 * np.pi * date.day_of_year / 365)
             time_features = [month_sin, month_cos, day_of_year_sin, day_of_year_cos]
-            evi_data_preprocessed = preprocess_image(evi_data, target_shape, mean, std)
+            evi_data_preprocessed = load_preprocessed_evi_data(evi_file_paths[date], target_shape, mean, std, cache_dir, resampling)
             evi_data_preprocessed_dict[date] = evi_data_preprocessed
             time_features_list.append(time_features)
         else:
@@ -224,13 +485,37 @@ def load_masked_evi_and_prepare_features(masked_evi, evi_date, time_index, targe
     return evi_data_preprocessed_dict, time_features_list, mean, std
 
 
+# Sorted datetime64 index answering many nearest-date queries at once with np.searchsorted.
+# Ties between an earlier and a later date resolve to the earlier one.
+class DateIndex:
+    def __init__(self, dates):
+        self.dates = pd.DatetimeIndex(list(dates)).unique().sort_values()
+        self.values = self.dates.values.astype('datetime64[ns]')
+        if len(self.values) == 0:
+            raise ValueError("DateIndex needs at least one date")
+
+    def __len__(self):
+        return len(self.values)
+
+    # Function to find the position of the nearest indexed date for each query date
+    def nearest_positions(self, dates):
+        query = pd.DatetimeIndex(dates).values.astype('datetime64[ns]')
+        if len(self.values) == 1:
+            return np.zeros(len(query), dtype=np.intp)
+        right = np.clip(np.searchsorted(self.values, query), 1, len(self.values) - 1)
+        left = right - 1
+        use_left = (query - self.values[left]) <= (self.values[right] - query)
+        return np.where(use_left, left, right)
+
+    # Function to find the nearest indexed date for each query date
+    def nearest(self, dates):
+        return self.dates[self.nearest_positions(dates)]
+
 def find_closest_date(date, date_dict):
-    closest_date = min(date_dict.keys(), key=lambda d: abs(d - date))
-    return closest_date
+    return DateIndex(date_dict.keys()).nearest([date])[0]
 
 def find_closest_date_in_df(date, df):
-    closest_date = min(df.index, key=lambda d: abs(d - date))
-    return closest_date
+    return DateIndex(df.index).nearest([date])[0]
 
 def mask_evi_data(evi_data, polygon_coords):
     mask = np.zeros_like(evi_data)
@@ -239,33 +524,311 @@ def mask_evi_data(evi_data, polygon_coords):
     return mask
 
 def predict(evi_data, time_features, mean, std, target_shape, model, device):
+    return predict_batch([evi_data], [time_features], mean, std, target_shape, model, device)
+
+# Function to predict several (EVI frame, time features) pairs in a single batched forward pass.
+# Frames that are the same array are preprocessed and encoded by the CNN + LSTM only once,
+# and the head then runs over every row at once.
+def predict_batch(evi_frames, time_features, mean, std, target_shape, model, device):
+    evi_sequences, frame_index = stack_unique_frames(evi_frames, mean, std, target_shape)
+    time_features = np.asarray(time_features, dtype=np.float32)
+    return run_model(model, evi_sequences, time_features, frame_index, device)
+
+# Function to preprocess the distinct frames (by identity) into (sequences, 1, 1, H, W) float32 sequences
+# and return them with the index of the sequence each input frame maps to
+def stack_unique_frames(evi_frames, mean, std, target_shape):
+    frame_ids = {}
+    frame_index = []
+    unique_frames = []
+    for evi_data in evi_frames:
+        if id(evi_data) not in frame_ids:
+            frame_ids[id(evi_data)] = len(unique_frames)
+            unique_frames.append(preprocess_image(evi_data, target_shape, mean, std))
+        frame_index.append(frame_ids[id(evi_data)])
+    evi_sequences = np.stack(unique_frames).astype(np.float32)[:, np.newaxis, np.newaxis]
+    return evi_sequences, np.array(frame_index, dtype=np.int64)
+
+# Default number of Monte Carlo dropout samples and the percentiles reported as the uncertainty band
+MC_DROPOUT_SAMPLES = 32
+MC_DROPOUT_PERCENTILES = (5, 95)
+
+# Function to predict like predict_batch, but with n_samples Monte Carlo dropout samples run as one batched
+# forward pass (HybridModel.sample_dropout). Returns the (n_samples, rows, ...) sampled outputs; seed makes
+# the dropout masks, and so the band, reproducible. Needs a PyTorch HybridModel.
+def predict_batch_samples(evi_frames, time_features, mean, std, target_shape, model, device, n_samples=MC_DROPOUT_SAMPLES, seed=0):
+    if not isinstance(model, torch.nn.Module):
+        raise TypeError(f"Monte Carlo dropout needs a PyTorch HybridModel, not {type(model).__name__}")
+    evi_sequences, frame_index = stack_unique_frames(evi_frames, mean, std, target_shape)
+    model.eval()
+    with torch.no_grad(), torch.random.fork_rng(devices=[]):
+        if seed is not None:
+            torch.manual_seed(seed)
+        samples = model.sample_dropout(torch.from_numpy(evi_sequences).to(device),
+                                       torch.tensor(np.asarray(time_features), dtype=torch.float32).to(device), n_samples,
+                                       torch.from_numpy(frame_index).to(device))
+    return samples.cpu().numpy()
+
+# Function to summarize sampled predictions (n_samples, ...) into their mean and percentile bands
+def summarize_samples(samples, percentiles=MC_DROPOUT_PERCENTILES):
+    bands = {'mean': samples.mean(axis=0)}
+    for q, band in zip(percentiles, np.percentile(samples, percentiles, axis=0)):
+        bands[f'p{q:g}'] = band
+    return bands
+
+# Function to run a model backend over distinct EVI sequences (sequences, time_steps, 1, H, W), one
+# time-feature row per prediction and the index of the sequence each row uses. HybridModel runs in torch;
+# any other backend (e.g. MVP_onnx_utils.OnnxYieldModel) is called with the numpy arrays and returns numpy.
+def run_model(model, evi_sequences, time_features, frame_index, device):
+    if not isinstance(model, torch.nn.Module):
+        return np.asarray(model(evi_sequences, time_features, frame_index))
     model.eval()
-    evi_data = preprocess_image(evi_data, target_shape, mean, std)
-    evi_data = torch.tensor(evi_data, dtype=torch.float32).unsqueeze(0).unsqueeze(0).to(device)
-    time_features = torch.tensor(time_features, dtype=torch.float32).unsqueeze(0).to(device)
     with torch.no_grad():
-        outputs = model(evi_data.unsqueeze(2), time_features) 
+        encoded = model.encode(torch.from_numpy(evi_sequences).to(device))
+        outputs = model.head(encoded[torch.from_numpy(frame_index).to(encoded.device)], torch.from_numpy(time_features).to(device))
     return outputs.cpu().numpy()
 
-def predict_weekly_yield(evi_data_dict, yield_data_weekly, start_date, polygon_area, mean, std, target_shape, model, device):
+# Largest mean relative deviation from fp32 accepted by enable_bf16
+BF16_MAX_RELATIVE_ERROR = 0.01
+
+# Function to build backtest inputs: for every week of the yield table, the nearest preprocessed EVI scene
+# and that week's time features
+def load_backtest_inputs(evi_data_dir, yield_data_weekly, target_shape, mean=None, std=None):
+    scene_dates = [pd.to_datetime(file.split('_')[3], format='%Y%m%d') for file in os.listdir(evi_data_dir) if file.endswith('.tiff')]
+    evi_data_dict, _, mean, std = load_evi_data_and_prepare_features(evi_data_dir, scene_dates, target_shape, mean=mean, std=std)
+    evi_frames = [evi_data_dict[date] for date in DateIndex(evi_data_dict.keys()).nearest(yield_data_weekly.index)]
+    time_features = yield_data_weekly[TIME_FEATURE_COLUMNS].values.astype(np.float32)
+    return evi_frames, time_features, mean, std
+
+# Function to switch a HybridModel to bfloat16 (MVP_model_utils.to_bfloat16) only if it is safe to: the CPU has
+# to support bfloat16 natively and the predictions on the given held-out weeks have to stay within
+# max_relative_error (mean absolute deviation over mean absolute fp32 prediction) of fp32.
+# Otherwise the model is left in (or restored to) fp32. Returns (enabled, relative_error or None).
+def enable_bf16(model, evi_frames, time_features, mean, std, target_shape, device='cpu', max_relative_error=BF16_MAX_RELATIVE_ERROR):
+    if model.bf16:
+        return True, None
+    if torch.device(device).type != 'cpu' or not cpu_supports_bf16():
+        return False, None
+    expected = predict_batch(evi_frames, time_features, mean, std, target_shape, model, device)
+    # Detached views of the fp32 weights, to() swaps the parameters' data so these keep the originals alive
+    fp32_state = model.state_dict()
+    to_bfloat16(model)
+    actual = predict_batch(evi_frames, time_features, mean, std, target_shape, model, device)
+    relative_error = float(np.abs(actual - expected).mean() / max(np.abs(expected).mean(), 1e-12))
+    if relative_error > max_relative_error:
+        model.load_state_dict(fp32_state, assign=True)
+        model.bf16 = False
+        return False, relative_error
+    return True, relative_error
+
+# Stateful forecaster for rolling weekly forecasts. It keeps the CNN embedding of every frame seen so far
+# and the LSTM (h, c) state after the last one, so adding a new scene costs one CNN pass and one LSTM step
+# instead of re-encoding the whole sequence. With window set, only the last `window` frames feed the LSTM
+# (like the fixed-length training sequences); dropping the oldest frame replays the LSTM over the kept
+# embeddings, which still skips the CNN.
+class RollingForecaster:
+    def __init__(self, model, mean, std, target_shape, device=None, window=None):
+        self.model = model
+        self.mean = mean
+        self.std = std
+        self.target_shape = target_shape
+        self.device = device
+        self.window = window
+        self.dates = []
+        self.embeddings = []
+        self.state = None
+        self.encoded = None
+
+    # Function to add the next EVI frame (raw or resized, preprocessed like predict does) to the sequence
+    def advance(self, evi_data, date=None):
+        self.model.eval()
+        frame = preprocess_image(evi_data, self.target_shape, self.mean, self.std)
+        frame = torch.tensor(frame, dtype=torch.float32).view(1, 1, *self.target_shape).to(self.device)
+        with torch.no_grad():
+            embedding = self.model.cnn(frame).unsqueeze(1)
+            self.embeddings.append(embedding)
+            self.dates.append(date)
+            if self.window is not None and len(self.embeddings) > self.window:
+                self.embeddings.pop(0)
+                self.dates.pop(0)
+                self.encoded, self.state = self.model.lstm_step(torch.cat(self.embeddings, dim=1))
+            else:
+                self.encoded, self.state = self.model.lstm_step(embedding, self.state)
+        return self
+
+    # Function to predict from the current sequence for one or more time-feature rows
+    def predict(self, time_features):
+        if self.encoded is None:
+            raise ValueError("RollingForecaster.predict needs at least one frame, call advance() first")
+        time_features = torch.tensor(np.atleast_2d(np.asarray(time_features, dtype=np.float32))).to(self.device)
+        with torch.no_grad():
+            outputs = self.model.head(self.encoded.expand(len(time_features), -1), time_features)
+        return outputs.cpu().numpy()
+
+# Volume columns of the yield table, in model input order
+VOLUME_COLUMNS = ['Volume (Pounds)', 'Cumulative Volumne (Pounds)']
+
+# Function to find which volume columns a yield MinMaxScaler was fitted on: MVP_utils.process_yield_data fits
+# both, the shipped yield_scaler.save (train_model/utils.py) only 'Volume (Pounds)'. Uses the scaler's feature
+# names, or its feature count when it was fitted on a bare array. Raises ValueError for any other scaler.
+def scaled_volume_columns(yield_scaler):
+    feature_names = getattr(yield_scaler, 'feature_names_in_', None)
+    if feature_names is not None:
+        columns = [str(name) for name in feature_names]
+    else:
+        columns = VOLUME_COLUMNS[:yield_scaler.n_features_in_]
+    if not columns or columns != [column for column in VOLUME_COLUMNS if column in columns] or len(columns) != yield_scaler.n_features_in_:
+        raise ValueError(f"Yield scaler fitted on {columns or yield_scaler.n_features_in_}, expected columns among {VOLUME_COLUMNS}")
+    return columns
+
+# Function to build a what-if grid over time features: every combination of the calendar dates and the
+# volume / cumulative volume assumptions. Volumes are in the units of the yield table. When the yield MinMaxScaler
+# is passed, the columns it was fitted on (see scaled_volume_columns) are given in pounds and scaled with it,
+# any other volume column stays in yield table units.
+# Returns a DataFrame with one row per scenario: the scenario parameters followed by TIME_FEATURE_COLUMNS.
+def scenario_grid(dates, volumes, cumulative_volumes, yield_scaler=None):
+    grid = pd.MultiIndex.from_product([pd.to_datetime(dates), volumes, cumulative_volumes],
+                                      names=['date', 'volume', 'cumulative_volume']).to_frame(index=False)
+    date_index = pd.DatetimeIndex(grid['date'])
+    grid['month_sin'] = np.sin(2 * np.pi * date_index.month / 12)
+    grid['month_cos'] = np.cos(2 * np.pi * date_index.month / 12)
+    grid['day_of_year_sin'] = np.sin(2 * np.pi * date_index.dayofyear / 365)
+    grid['day_of_year_cos'] = np.cos(2 * np.pi * date_index.dayofyear / 365)
+    grid[VOLUME_COLUMNS] = grid[['volume', 'cumulative_volume']].to_numpy(dtype=np.float64)
+    if yield_scaler is not None:
+        scaled_columns = scaled_volume_columns(yield_scaler)
+        volumes = grid[scaled_columns]
+        grid[scaled_columns] = yield_scaler.transform(volumes if hasattr(yield_scaler, 'feature_names_in_') else volumes.to_numpy())
+    return grid
+
+# Function to evaluate what-if scenarios (a scenario_grid DataFrame or rows of TIME_FEATURE_COLUMNS values)
+# against one EVI sequence (a frame, or a list of frames in time order). The CNN + LSTM encode the sequence once
+# through RollingForecaster and only the head runs, over the scenarios in batches of chunk_size. Other backends
+# get the whole grid in one run_model call, which also encodes the sequence once.
+# Returns the forecast total for each scenario, in grid order.
+def predict_scenarios(evi_sequence, scenarios, mean, std, target_shape, model, device=None, chunk_size=256):
+    if isinstance(scenarios, pd.DataFrame):
+        scenarios = scenarios[TIME_FEATURE_COLUMNS].values
+    time_features = np.atleast_2d(np.asarray(scenarios, dtype=np.float32))
+    evi_frames = evi_sequence if isinstance(evi_sequence, (list, tuple)) else [evi_sequence]
+
+    if not isinstance(model, torch.nn.Module):
+        frames = [preprocess_image(evi_data, target_shape, mean, std) for evi_data in evi_frames]
+        evi_sequences = np.stack(frames).astype(np.float32)[np.newaxis, :, np.newaxis]
+        outputs = run_model(model, evi_sequences, time_features, np.zeros(len(time_features), dtype=np.int64), device)
+        return outputs.reshape(len(time_features), -1).sum(axis=1)
+
+    forecaster = RollingForecaster(model, mean, std, target_shape, device)
+    for evi_data in evi_frames:
+        forecaster.advance(evi_data)
+    # Chunks keep the per-pixel head's (rows, H, W) output bounded
+    totals = []
+    for start in range(0, len(time_features), chunk_size):
+        outputs = forecaster.predict(time_features[start:start + chunk_size])
+        totals.append(outputs.reshape(len(outputs), -1).sum(axis=1))
+    return np.concatenate(totals) if totals else np.zeros(0, dtype=np.float32)
+
+# Function to check RollingForecaster against full-sequence forward passes: after each advance() the
+# prediction must match model() run over the same (windowed) sequence. Returns the largest relative difference.
+def check_rolling_consistency(model, evi_frames, time_features, mean, std, target_shape, device=None, window=None):
     model.eval()
-    predicted_yields = []
-    dates = []
-    
-    for week_offset in range(2):  # 13 weeks for 3 months - modified to 2 weeks to speed up prediction
-        date_to_predict = start_date + timedelta(weeks=week_offset)
-        
-        closest_evi_date = find_closest_date(date_to_predict, evi_data_dict)
-        closest_yield_date = find_closest_date_in_df(date_to_predict, yield_data_weekly)
-        
-        evi_data = evi_data_dict[closest_evi_date]
-        time_features = yield_data_weekly.loc[closest_yield_date, ['month_sin', 'month_cos', 'day_of_year_sin', 'day_of_year_cos', 'Volume (Pounds)', 'Cumulative Volumne (Pounds)']].values
-        
-        predicted_yield_per_acre = predict(evi_data, time_features, mean, std, target_shape, model, device)
-        
-        predicted_yield_total = np.sum(predicted_yield_per_acre)
-        # predicted_yield_total = np.sum(predicted_yield_per_acre) * polygon_area
-        predicted_yields.append(predicted_yield_total)
-        dates.append(date_to_predict)
+    forecaster = RollingForecaster(model, mean, std, target_shape, device, window)
+    frames = [preprocess_image(evi_data, target_shape, mean, std) for evi_data in evi_frames]
+    time_features = np.atleast_2d(np.asarray(time_features, dtype=np.float32))
+    worst = 0.0
+    for step, evi_data in enumerate(evi_frames):
+        rolling = forecaster.advance(evi_data).predict(time_features)
+        sequence = frames[max(0, step + 1 - window) if window else 0:step + 1]
+        sequence = torch.tensor(np.stack(sequence), dtype=torch.float32).view(1, len(sequence), 1, *target_shape).to(device)
+        with torch.no_grad():
+            full = model.head(model.encode(sequence).expand(len(time_features), -1), torch.tensor(time_features).to(device)).cpu().numpy()
+        worst = max(worst, float(np.abs(rolling - full).max() / max(np.abs(full).max(), 1e-6)))
+    return worst
+
+# yield_date_index can be a prebuilt DateIndex over yield_data_weekly.index to avoid rebuilding it per call
+def predict_weekly_yield(evi_data_dict, yield_data_weekly, start_date, polygon_area, mean, std, target_shape, model, device, weeks=13, yield_date_index=None):
+    dates, evi_frames, time_features_list = weekly_inputs(evi_data_dict, yield_data_weekly, start_date, weeks, yield_date_index)
+
+    predicted_yield_per_acre = predict_batch(evi_frames, time_features_list, mean, std, target_shape, model, device)
+
+    predicted_yields = list(predicted_yield_per_acre.reshape(weeks, -1).sum(axis=1))
+    # predicted_yields = list(predicted_yield_per_acre.reshape(weeks, -1).sum(axis=1) * polygon_area)
     
-    return dates, predicted_yields
\ No newline at end of file
+    return dates, predicted_yields
+
+# Function to pick the inputs of a weekly forecast: for each of the `weeks` weeks from start_date, the
+# nearest EVI scene and the time features of the nearest week in the yield table
+def weekly_inputs(evi_data_dict, yield_data_weekly, start_date, weeks, yield_date_index=None):
+    dates = [start_date + timedelta(weeks=week_offset) for week_offset in range(weeks)]  # 13 weeks for 3 months
+
+    if yield_date_index is None:
+        yield_date_index = DateIndex(yield_data_weekly.index)
+    closest_evi_dates = DateIndex(evi_data_dict.keys()).nearest(dates)
+    closest_yield_dates = yield_date_index.nearest(dates)
+
+    evi_frames = [evi_data_dict[date] for date in closest_evi_dates]
+    time_features_list = yield_data_weekly.loc[closest_yield_dates, TIME_FEATURE_COLUMNS].values.astype(np.float32)
+    return dates, evi_frames, time_features_list
+
+# Function to forecast weekly yield with Monte Carlo dropout uncertainty. Each sample's per-pixel output is
+# summed per week before taking percentiles, so the band is over weekly totals.
+# Returns (dates, {'mean': [...], 'p5': [...], 'p95': [...]}) with one value per week.
+def predict_weekly_yield_bands(evi_data_dict, yield_data_weekly, start_date, mean, std, target_shape, model, device, weeks=13,
+                               yield_date_index=None, n_samples=MC_DROPOUT_SAMPLES, percentiles=MC_DROPOUT_PERCENTILES, seed=0):
+    dates, evi_frames, time_features_list = weekly_inputs(evi_data_dict, yield_data_weekly, start_date, weeks, yield_date_index)
+    samples = predict_batch_samples(evi_frames, time_features_list, mean, std, target_shape, model, device, n_samples, seed)
+    weekly_totals = samples.reshape(n_samples, weeks, -1).sum(axis=2)
+    return dates, {name: [float(value) for value in band] for name, band in summarize_samples(weekly_totals, percentiles).items()}
+
+# Function to hash the time features a forecast reads, so edits to the yield table invalidate cached forecasts
+def yield_data_version(yield_data_weekly):
+    return make_cache_key(pd.util.hash_pandas_object(yield_data_weekly[TIME_FEATURE_COLUMNS], index=True).values.tobytes())
+
+# Function to serve a forecast from the prediction cache, or compute and store it. With a SingleFlight, concurrent
+# calls for the same key (e.g. several sessions right after a new scene lands) share one computation.
+def _cached_forecast(prediction_cache, key, compute, single_flight=None):
+    def compute_and_store():
+        value = compute()
+        prediction_cache.put(key, value)
+        return value
+
+    if single_flight is not None:
+        return single_flight.do(key, compute_and_store, lambda: prediction_cache.get(key))
+    cached = prediction_cache.get(key)
+    return cached if cached is not None else compute_and_store()
+
+# Function to run load_evi_data_and_prepare_features + predict_weekly_yield behind a PredictionCache.
+# The forecast only depends on the scenes in evi_data_dir, the start date, the model and the horizon,
+# so it is served from the cache whenever those match; model_version identifies the model (see PredictionCache.key).
+def cached_weekly_yield(prediction_cache, model_version, evi_data_dir, yield_data_weekly, start_date, target_shape, model, device,
+                        weeks=13, mean=None, std=None, yield_date_index=None, single_flight=None):
+    scene_hashes = [file_sha256(os.path.join(evi_data_dir, file)) for file in os.listdir(evi_data_dir) if file.endswith('.tiff')]
+    key = prediction_cache.key(scene_hashes, start_date, model_version, weeks, tuple(target_shape), yield_data_version(yield_data_weekly), EVI_RESAMPLING)
+
+    def compute():
+        time_index = list(yield_data_weekly.index)
+        evi_data_dict, _, evi_mean, evi_std = load_evi_data_and_prepare_features(evi_data_dir, time_index, target_shape, mean=mean, std=std)
+        dates, predicted_yields = predict_weekly_yield(evi_data_dict, yield_data_weekly, start_date, None, evi_mean, evi_std, target_shape, model, device,
+                                                       weeks=weeks, yield_date_index=yield_date_index)
+        return {'dates': [date.isoformat() for date in dates], 'predicted_yields': [float(predicted_yield) for predicted_yield in predicted_yields]}
+
+    forecast = _cached_forecast(prediction_cache, key, compute, single_flight)
+    return [pd.Timestamp(date) for date in forecast['dates']], forecast['predicted_yields']
+
+# Function to run predict_weekly_yield_bands behind a PredictionCache, like cached_weekly_yield.
+# The sample count, percentiles and seed are part of the key, so the cached band is exactly what a rerun would give.
+def cached_weekly_yield_bands(prediction_cache, model_version, evi_data_dir, yield_data_weekly, start_date, target_shape, model, device,
+                              weeks=13, mean=None, std=None, yield_date_index=None, n_samples=MC_DROPOUT_SAMPLES,
+                              percentiles=MC_DROPOUT_PERCENTILES, seed=0, single_flight=None):
+    scene_hashes = [file_sha256(os.path.join(evi_data_dir, file)) for file in os.listdir(evi_data_dir) if file.endswith('.tiff')]
+    key = prediction_cache.key(scene_hashes, start_date, model_version, weeks, tuple(target_shape), yield_data_version(yield_data_weekly), EVI_RESAMPLING,
+                               'mc_dropout', n_samples, tuple(percentiles), seed)
+
+    def compute():
+        time_index = list(yield_data_weekly.index)
+        evi_data_dict, _, evi_mean, evi_std = load_evi_data_and_prepare_features(evi_data_dir, time_index, target_shape, mean=mean, std=std)
+        dates, bands = predict_weekly_yield_bands(evi_data_dict, yield_data_weekly, start_date, evi_mean, evi_std, target_shape, model, device, weeks,
+                                                  yield_date_index, n_samples, percentiles, seed)
+        return {'dates': [date.isoformat() for date in dates], 'bands': bands}
+
+    forecast = _cached_forecast(prediction_cache, key, compute, single_flight)
+    return [pd.Timestamp(date) for date in forecast['dates']], forecast['bands']
@@ -1,3 +1,6 @@
+import copy
+import gc
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -6,9 +9,20 @@ from skimage.transform import resize
 
 target_shape = (512, 512)
 
+# Cast a layer's input to the dtype of its weights (bfloat16 layers after to_bfloat16). Dynamically quantized
+# layers expose weight() as a method and take float input, so they are left alone.
+def _match_dtype(layer, x):
+    weight = getattr(layer, 'weight', None)
+    return x.to(weight.dtype) if isinstance(weight, torch.Tensor) else x
+
+# Output size of a conv/pool layer along one spatial dimension
+def _conv_output_size(size, kernel_size, stride, padding, dilation):
+    return (size + 2 * padding - dilation * (kernel_size - 1) - 1) // stride + 1
+
 class CNNFeatureExtractor(nn.Module):
-    def __init__(self):
+    def __init__(self, target_shape=target_shape):
         super(CNNFeatureExtractor, self).__init__()
+        self.target_shape = tuple(target_shape)
         self.conv1 = nn.Conv2d(1, 32, 3, padding=1)
         self.bn1 = nn.BatchNorm2d(32)
         self.conv2 = nn.Conv2d(32, 64, 3, padding=1)
@@ -19,50 +33,224 @@ class CNNFeatureExtractor(nn.Module):
         self.bn4 = nn.BatchNorm2d(256)
         self.pool = nn.MaxPool2d(2, 2)
         self.dropout = nn.Dropout(0.5)
-        self.flattened_size = self._get_conv_output((1, *target_shape))
+        self.flattened_size = self._get_conv_output((1, *self.target_shape))
         self.fc1 = nn.Linear(self.flattened_size, 512)
 
+    # Flattened size after the four conv + pool blocks, worked out from the layer configuration
+    # instead of running a forward pass (so it also works for modules built on the meta device)
     def _get_conv_output(self, shape):
-        x = torch.rand(1, *shape)
-        x = self.pool(F.relu(self.bn1(self.conv1(x))))
-        x = self.pool(F.relu(self.bn2(self.conv2(x))))
-        x = self.pool(F.relu(self.bn3(self.conv3(x))))
-        x = self.pool(F.relu(self.bn4(self.conv4(x))))
-        n_size = x.view(1, -1).size(1)
-        return n_size
+        channels, height, width = shape
+        pool = self.pool
+        for conv in (self.conv1, self.conv2, self.conv3, self.conv4):
+            height = _conv_output_size(height, conv.kernel_size[0], conv.stride[0], conv.padding[0], conv.dilation[0])
+            width = _conv_output_size(width, conv.kernel_size[1], conv.stride[1], conv.padding[1], conv.dilation[1])
+            height = _conv_output_size(height, pool.kernel_size, pool.stride, pool.padding, pool.dilation)
+            width = _conv_output_size(width, pool.kernel_size, pool.stride, pool.padding, pool.dilation)
+            channels = conv.out_channels
+        return channels * height * width
 
-    def forward(self, x):
+    # The four conv + pool blocks, deterministic in eval mode
+    def conv_features(self, x):
+        x = _match_dtype(self.conv1, x)
         x = self.pool(F.relu(self.bn1(self.conv1(x))))
         x = self.pool(F.relu(self.bn2(self.conv2(x))))
         x = self.pool(F.relu(self.bn3(self.conv3(x))))
         x = self.pool(F.relu(self.bn4(self.conv4(x))))
-        x = self.dropout(x)
+        return x
+
+    # Dropout and fc1 on top of conv_features. sample_dropout=True keeps dropout active in eval mode
+    # (Monte Carlo dropout) while batch norm stays frozen.
+    def embed(self, x, sample_dropout=False):
+        x = F.dropout(x, self.dropout.p, training=self.training or sample_dropout)
         x = x.view(-1, self.flattened_size)
         x = F.relu(self.fc1(x))
         return x
+
+    def forward(self, x):
+        return self.embed(self.conv_features(x))
     
 class HybridModel(nn.Module):
-    def __init__(self, cnn_feature_extractor, lstm_hidden_size=64, lstm_layers=1):
+    # scalar_target=True trains a compact head: fc2 predicts one value per sample, the mean of the per-pixel map,
+    # instead of the 262,144 pixel values (see expand_to_per_pixel)
+    def __init__(self, cnn_feature_extractor, lstm_hidden_size=64, lstm_layers=1, scalar_target=False):
         super(HybridModel, self).__init__()
         self.cnn = cnn_feature_extractor
         self.lstm = nn.LSTM(input_size=512, hidden_size=lstm_hidden_size, num_layers=lstm_layers, batch_first=True)
         self.fc1 = nn.Linear(lstm_hidden_size + 6, 64)
-        self.fc2 = nn.Linear(64, target_shape[0] * target_shape[1])  # Predict a value per pixel
-        self.target_shape = target_shape
+        self.target_shape = cnn_feature_extractor.target_shape
+        self.fc2 = nn.Linear(64, 1 if scalar_target else self.target_shape[0] * self.target_shape[1])  # Predict a value per pixel
+        self.scalar_target = scalar_target
+        self.total_yield = False  # see collapse_to_total_yield
+        self.bf16 = False  # see to_bfloat16
 
-    def forward(self, x, time_features):
+    # Run the CNN + LSTM over an EVI sequence and return the last LSTM output
+    def encode(self, x):
         batch_size, time_steps, C, H, W = x.size()
         c_in = x.view(batch_size * time_steps, C, H, W)
         c_out = self.cnn(c_in)
         r_in = c_out.view(batch_size, time_steps, -1)
-        r_out, (h_n, c_n) = self.lstm(r_in)
-        r_out = r_out[:, -1, :]
+        r_out, state = self.lstm_step(r_in)
+        return r_out
+
+    # Advance the LSTM over CNN embeddings (batch, steps, 512) starting from state (h, c), or from zeros when None.
+    # Returns the last LSTM output and the new (h, c), so a sequence can be encoded incrementally.
+    def lstm_step(self, r_in, state=None):
+        r_out, state = self.lstm(r_in.float(), state)  # The LSTM always runs in fp32, see to_bfloat16
+        return r_out[:, -1, :], state
+
+    # Combine an encoded sequence with its time features into the per-pixel prediction
+    def head(self, r_out, time_features):
         x = torch.cat((r_out, time_features), dim=1)  # Concatenate LSTM output with time features
-        x = F.relu(self.fc1(x))
-        x = self.fc2(x)
-        x = x.view(batch_size, *self.target_shape)  # Reshape to the target shape
+        x = F.relu(self.fc1(_match_dtype(self.fc1, x)))
+        x = self.fc2(_match_dtype(self.fc2, x)).float()
+        if self.total_yield or self.scalar_target:
+            return x.view(r_out.size(0))  # One total (or per-pixel mean) per sample
+        x = x.view(r_out.size(0), *self.target_shape)  # Reshape to the target shape
         return x
 
+    def forward(self, x, time_features):
+        return self.head(self.encode(x), time_features)
+
+    # Monte Carlo dropout: n_samples stochastic passes through the dropout layer, run as one batch.
+    # The conv blocks in front of the dropout are deterministic in eval mode, so they run once per sequence and
+    # only their output is replicated; dropout, fc1, LSTM and head then see an n_samples times larger batch.
+    # x holds the distinct sequences (sequences, steps, 1, H, W) and frame_index picks one for each time-feature
+    # row (one row per sequence when None). Returns (n_samples, rows, ...) outputs.
+    def sample_dropout(self, x, time_features, n_samples, frame_index=None):
+        n_sequences, time_steps, C, H, W = x.size()
+        if frame_index is None:
+            frame_index = torch.arange(n_sequences, device=x.device)
+        features = self.cnn.conv_features(x.view(n_sequences * time_steps, C, H, W))
+        c_out = self.cnn.embed(features.repeat(n_samples, 1, 1, 1), sample_dropout=True)
+        r_out, state = self.lstm_step(c_out.view(n_samples * n_sequences, time_steps, -1))
+        # Row i of sample s uses sequence frame_index[i] of replica s
+        rows = (torch.arange(n_samples, device=x.device)[:, None] * n_sequences + frame_index[None, :]).reshape(-1)
+        outputs = self.head(r_out[rows], time_features.repeat(n_samples, 1))
+        return outputs.view(n_samples, len(frame_index), *outputs.shape[1:])
+
+    # Replace the per-pixel fc2 with a 64 -> 1 layer that outputs the sum over all pixels.
+    # sum_p(w_p . x + b_p) == (sum_p w_p) . x + sum_p b_p, so the total is exact without retraining.
+    # The row sums are taken in float64 to keep the rounding error of 262,144 terms out of the weights.
+    def collapse_to_total_yield(self):
+        if self.total_yield:
+            return self
+        if self.scalar_target:
+            # The expanded map predicts the scalar output at every pixel, so the total is it times the pixel count
+            with torch.no_grad():
+                self.fc2.weight.mul_(self.target_shape[0] * self.target_shape[1])
+                self.fc2.bias.mul_(self.target_shape[0] * self.target_shape[1])
+            self.scalar_target = False
+            self.total_yield = True
+            return self
+        fc2 = nn.Linear(self.fc2.in_features, 1, device=self.fc2.weight.device, dtype=self.fc2.weight.dtype)
+        with torch.no_grad():
+            fc2.weight.copy_(self.fc2.weight.double().sum(dim=0, keepdim=True))
+            fc2.bias.copy_(self.fc2.bias.double().sum().view(1))
+        self.fc2 = fc2
+        self.total_yield = True
+        return self
+
+    # Replace the compact fc2 of a scalar_target model with the per-pixel layer that per-pixel consumers expect.
+    # Every pixel gets the scalar weights, so the map is uniform, its mean is the scalar prediction and
+    # collapse_to_total_yield gives the same total from either form.
+    def expand_to_per_pixel(self):
+        if not self.scalar_target:
+            return self
+        n_pixels = self.target_shape[0] * self.target_shape[1]
+        fc2 = nn.Linear(self.fc2.in_features, n_pixels, device=self.fc2.weight.device, dtype=self.fc2.weight.dtype)
+        with torch.no_grad():
+            fc2.weight.copy_(self.fc2.weight.expand(n_pixels, -1))
+            fc2.bias.copy_(self.fc2.bias.expand(n_pixels))
+        self.fc2 = fc2
+        self.scalar_target = False
+        return self
+
+# Layers covered by dynamic int8 quantization, they hold nearly all of the model's parameters
+QUANTIZED_LAYERS = ['cnn.fc1', 'lstm', 'fc1', 'fc2']
+
+# Function to apply dynamic int8 quantization (int8 weights, activations quantized on the fly) in place.
+# Only supported on CPU.
+def quantize_model(model):
+    # The collapsed total-yield fc2 only has 65 parameters, quantizing it would just add error
+    layers = {name for name in QUANTIZED_LAYERS if not (name == 'fc2' and model.total_yield)}
+    torch.ao.quantization.quantize_dynamic(model, layers, dtype=torch.qint8, inplace=True)
+    # The swapped-out fp32 layers sit in reference cycles, collect them now so their ~500 MB is released right away
+    gc.collect()
+    return model
+
+# Function to check whether the CPU runs bfloat16 conv / matmul natively (AVX512-BF16 or AMX through oneDNN).
+# Without it bfloat16 is emulated and slower than fp32.
+def cpu_supports_bf16():
+    try:
+        return torch.backends.mkldnn.is_available() and bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+# Function to switch a model to bfloat16 in place: the CNN (conv maps and fc1) and the head layers.
+# The LSTM stays in fp32, it is small and its recurrence is where bfloat16 rounding would build up, and so does
+# the collapsed total-yield fc2 (65 parameters holding sums over 262,144 pixels). Outputs are returned in fp32.
+# Use MVP_inference_utils.enable_bf16 to switch only when the result stays close to fp32.
+def to_bfloat16(model):
+    model.cnn.to(torch.bfloat16)
+    model.fc1.to(torch.bfloat16)
+    if not model.total_yield:
+        model.fc2.to(torch.bfloat16)
+    model.bf16 = True
+    return model
+
+# Function to load a trained HybridModel for inference.
+# total_yield=True collapses the per-pixel head so the model returns one summed yield per sample, otherwise
+# checkpoints trained with scalar_target are expanded to the per-pixel head,
+# quantize=True switches to the dynamic int8 variant (CPU only).
+# The model is built on the meta device (no memory, no random init) and the checkpoint tensors are
+# assigned straight into it, so construction costs nothing beyond reading the file.
+# Single-file artifacts (MVP_artifact_utils) are memory-mapped instead, use load_model_artifact to also get
+# their preprocessing metadata.
+def load_model(model_path, total_yield=False, device='cpu', quantize=False):
+    if str(model_path).endswith('.safetensors'):
+        from MVP_artifact_utils import load_model_artifact
+        return load_model_artifact(model_path, total_yield, device, quantize)[0]
+    # Memory-mapped, so processes loading the same checkpoint (e.g. WorkerPool workers) share its pages through the
+    # page cache until they write to them. Checkpoints in the legacy non-zip format cannot be mapped.
+    # Not for quantize: the mapping would keep every fp32 page resident after quantization replaced the layers.
+    try:
+        state_dict = torch.load(model_path, map_location=torch.device(device), mmap=not quantize)
+    except RuntimeError:
+        state_dict = torch.load(model_path, map_location=torch.device(device))
+    with torch.device('meta'):
+        model = HybridModel(CNNFeatureExtractor(), scalar_target=state_dict['fc2.weight'].shape[0] == 1)
+    model.load_state_dict(state_dict, assign=True)
+    return prepare_for_inference(model, total_yield, device, quantize)
+
+# Function to finish a loaded model for inference: collapse the head, move it to the device, switch to eval
+# and optionally quantize
+def prepare_for_inference(model, total_yield=False, device='cpu', quantize=False):
+    if total_yield:
+        model.collapse_to_total_yield()
+    else:
+        model.expand_to_per_pixel()
+    model.to(device)
+    model.eval()
+    if quantize:
+        if torch.device(device).type != 'cpu':
+            raise ValueError("Dynamic int8 quantization is only supported on CPU")
+        quantize_model(model)
+    return model
+
+# Function to check a collapsed copy of a per-pixel model against the original on random head inputs.
+# Returns the largest relative difference between the summed per-pixel output and the collapsed output.
+def check_total_yield_parity(model, n_samples=8, seed=0):
+    collapsed = copy.deepcopy(model).collapse_to_total_yield().eval()
+    model.eval()
+    generator = torch.Generator().manual_seed(seed)
+    device = model.fc1.weight.device
+    r_out = torch.randn(n_samples, model.lstm.hidden_size, generator=generator).to(device)
+    time_features = torch.randn(n_samples, model.fc1.in_features - model.lstm.hidden_size, generator=generator).to(device)
+    with torch.no_grad():
+        per_pixel_total = model.head(r_out, time_features).double().sum(dim=(1, 2))
+        total = collapsed.head(r_out, time_features).double()
+    return ((per_pixel_total - total).abs() / per_pixel_total.abs().clamp_min(1e-6)).max().item()
+
 # def preprocess_input(evi_data_dict, evi_reference, sequence_length=4):
 #     evi_sequence = []
 #     for i in range(sequence_length):
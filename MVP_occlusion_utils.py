@@ -0,0 +1,140 @@
+import numpy as np
+import rasterio
+import rasterio.features
+import rasterio.mask
+import torch
+from rasterio.io import MemoryFile
+from skimage.transform import resize
+
+from MVP_inference_utils import RollingForecaster, preprocess_image, run_model
+
+# Most occluded variants aoi_occlusion_map runs when it picks the patch size itself. Each variant is a CNN pass
+# over a full frame (about 0.4 s on CPU at 512x512), so this keeps a map to a few batched passes.
+OCCLUSION_MAX_VARIANTS = 64
+
+
+# Function to list the top-left corners of every occlusion patch inside region (row0, row1, col0, col1),
+# the last patch in each direction is shifted back so the whole region is covered
+def occlusion_positions(region, patch_size, stride):
+    row0, row1, col0, col1 = region
+    def starts(start, stop):
+        last = max(start, stop - patch_size)
+        return sorted(set(range(start, last + 1, stride)) | {last})
+    return [(row, col) for row in starts(row0, row1) for col in starts(col0, col1)]
+
+
+# Function to compute an occlusion-sensitivity map for a forecast: every patch_size x patch_size patch of the
+# last EVI frame (inside region, the whole frame by default) is replaced by fill and the model is rerun.
+# fill=0 is the training mean after normalization. The value of a pixel is the average drop in predicted total
+# yield when the patches covering it are hidden, so positive values mark areas that raise the forecast.
+# evi_sequence is a frame or a list of frames in time order, processed like predict does. With a PyTorch model
+# the earlier frames go through the CNN + LSTM once and only the occluded variants of the last frame run, in
+# batches of batch_size, from the cached LSTM state; other backends get each batch as one run_model call.
+# Returns a target_shape float32 map (zero outside region) and the unoccluded total.
+def occlusion_sensitivity(evi_sequence, time_features, mean, std, target_shape, model, device=None, patch_size=16, stride=None,
+                          region=None, fill=0.0, batch_size=16):
+    evi_frames = evi_sequence if isinstance(evi_sequence, (list, tuple)) else [evi_sequence]
+    frames = [preprocess_image(evi_data, target_shape, mean, std).astype(np.float32) for evi_data in evi_frames]
+    time_features = np.asarray(time_features, dtype=np.float32).reshape(1, -1)
+    region = region or (0, target_shape[0], 0, target_shape[1])
+    positions = occlusion_positions(region, patch_size, stride or patch_size)
+
+    if isinstance(model, torch.nn.Module):
+        model.eval()
+        forecaster = RollingForecaster(model, 0.0, 1.0, target_shape, device)
+        for frame in frames[:-1]:
+            forecaster.advance(frame)
+        context_state = forecaster.state
+        time_features_tensor = torch.from_numpy(time_features).to(device)
+
+        def predict_last_frames(last_frames):
+            with torch.no_grad():
+                c_out = model.cnn(torch.from_numpy(last_frames).unsqueeze(1).to(device))
+                state = None
+                if context_state is not None:
+                    state = tuple(tensor.expand(-1, len(last_frames), -1).contiguous() for tensor in context_state)
+                r_out, state = model.lstm_step(c_out.unsqueeze(1), state)
+                outputs = model.head(r_out, time_features_tensor.expand(len(last_frames), -1))
+            return outputs.cpu().numpy().reshape(len(last_frames), -1).sum(axis=1)
+    else:
+        context = np.stack(frames[:-1]) if len(frames) > 1 else np.zeros((0, *target_shape), dtype=np.float32)
+
+        def predict_last_frames(last_frames):
+            evi_sequences = np.concatenate([np.broadcast_to(context, (len(last_frames), *context.shape)), last_frames[:, np.newaxis]], axis=1)
+            outputs = run_model(model, evi_sequences[:, :, np.newaxis], np.repeat(time_features, len(last_frames), axis=0),
+                                np.arange(len(last_frames), dtype=np.int64), device)
+            return np.asarray(outputs).reshape(len(last_frames), -1).sum(axis=1)
+
+    baseline = float(predict_last_frames(frames[-1][np.newaxis])[0])
+    total_drop = np.zeros(target_shape, dtype=np.float64)
+    coverage = np.zeros(target_shape, dtype=np.int32)
+    for start in range(0, len(positions), batch_size):
+        batch_positions = positions[start:start + batch_size]
+        occluded = np.repeat(frames[-1][np.newaxis], len(batch_positions), axis=0)
+        for variant, (row, col) in zip(occluded, batch_positions):
+            variant[row:row + patch_size, col:col + patch_size] = fill
+        totals = predict_last_frames(occluded)
+        for total, (row, col) in zip(totals, batch_positions):
+            total_drop[row:row + patch_size, col:col + patch_size] += baseline - total
+            coverage[row:row + patch_size, col:col + patch_size] += 1
+    return (total_drop / np.maximum(coverage, 1)).astype(np.float32), baseline
+
+
+# Function to get the GeoJSON geometries out of an AOI drawing or feature collection, like landsat_handler.mask_tif
+def _aoi_geometries(area_to_mask):
+    if "geometry" in area_to_mask:
+        return [area_to_mask["geometry"]]
+    return [feature["geometry"] for feature in area_to_mask["features"]]
+
+
+# Function to find the AOI's bounding box in model input coordinates (row0, row1, col0, col1) for a scene
+# resized to target_shape, padded to at least one patch so it can be passed as the occlusion region
+def aoi_region(scene_path, area_to_mask, target_shape, patch_size=1):
+    with rasterio.open(scene_path) as src:
+        window = rasterio.features.geometry_window(src, _aoi_geometries(area_to_mask))
+        scene_height, scene_width = src.height, src.width
+    row_scale, col_scale = target_shape[0] / scene_height, target_shape[1] / scene_width
+    row0, col0 = int(window.row_off * row_scale), int(window.col_off * col_scale)
+    row1 = max(int(np.ceil((window.row_off + window.height) * row_scale)), row0 + patch_size)
+    col1 = max(int(np.ceil((window.col_off + window.width) * col_scale)), col0 + patch_size)
+    return max(0, min(row0, target_shape[0] - patch_size)), min(row1, target_shape[0]), max(0, min(col0, target_shape[1] - patch_size)), min(col1, target_shape[1])
+
+
+# Function to bring a model-input heatmap back onto the scene's grid and crop it to the AOI the same way
+# landsat_handler.mask_tif crops rasters (pixels outside the AOI are NaN). Returns (heatmap, transform).
+def heatmap_to_aoi(heatmap, scene_path, area_to_mask):
+    with rasterio.open(scene_path) as src:
+        profile = src.profile.copy()
+    # Nearest neighbour keeps the patch edges sharp instead of inventing gradients between patches
+    scene_heatmap = resize(heatmap, (profile['height'], profile['width']), order=0, preserve_range=True, anti_aliasing=False).astype(np.float32)
+    profile.update(count=1, dtype='float32', nodata=np.nan)
+    with MemoryFile() as memory_file:
+        with memory_file.open(**profile) as dst:
+            dst.write(scene_heatmap, 1)
+        with memory_file.open() as src:
+            out_image, out_transform = rasterio.mask.mask(src, _aoi_geometries(area_to_mask), crop=True, nodata=np.nan)
+    return out_image[0], out_transform
+
+
+# Function to pick the smallest square patch (stride = patch size) that covers region (row0, row1, col0, col1) in
+# at most max_variants occluded variants
+def occlusion_patch_size(region, max_variants=OCCLUSION_MAX_VARIANTS, min_patch_size=1):
+    row0, row1, col0, col1 = region
+    patch_size = max(min_patch_size, int(np.ceil(np.sqrt((row1 - row0) * (col1 - col0) / max_variants))))
+    while len(occlusion_positions(region, patch_size, patch_size)) > max_variants:
+        patch_size += 1
+    return patch_size
+
+# Function to compute the occlusion map of a forecast over the user's AOI: occlusion runs only over the AOI's
+# bounding box in the scene and the result comes back cropped to the AOI on the scene grid. Without a patch_size
+# the finest patches that keep the map within max_variants model variants are used.
+# evi_data is the scene at scene_path (processed like predict does). Returns (heatmap, transform, baseline total).
+def aoi_occlusion_map(evi_data, scene_path, area_to_mask, time_features, mean, std, target_shape, model, device=None, patch_size=None,
+                      stride=None, batch_size=16, max_variants=OCCLUSION_MAX_VARIANTS):
+    if patch_size is None:
+        patch_size = occlusion_patch_size(aoi_region(scene_path, area_to_mask, target_shape), max_variants)
+    region = aoi_region(scene_path, area_to_mask, target_shape, patch_size)
+    heatmap, baseline = occlusion_sensitivity(evi_data, time_features, mean, std, target_shape, model, device, patch_size, stride, region,
+                                              batch_size=batch_size)
+    aoi_heatmap, transform = heatmap_to_aoi(heatmap, scene_path, area_to_mask)
+    return aoi_heatmap, transform, baseline
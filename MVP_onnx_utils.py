@@ -0,0 +1,97 @@
+import inspect
+
+import numpy as np
+
+# Graph input/output names used by export_onnx and OnnxYieldModel
+ONNX_INPUT_NAMES = ['evi_sequences', 'time_features', 'frame_index']
+ONNX_OUTPUT_NAME = 'yield'
+
+
+# Function to export a HybridModel (CNN + LSTM + head) to ONNX.
+# The graph takes the distinct EVI sequences, one time-feature row per prediction and the index of the
+# sequence each row uses, so a backend can encode every distinct sequence once like predict_batch does.
+# The number of sequences, the number of rows and the sequence length are all dynamic axes.
+def export_onnx(model, onnx_path, sequence_length=1, opset_version=17):
+    # torch is only needed to export, the ONNX Runtime backend below does not import it
+    import torch
+
+    class IndexedHybridModel(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, evi_sequences, time_features, frame_index):
+            return self.model.head(self.model.encode(evi_sequences)[frame_index], time_features)
+
+    model.eval()
+    n_time_features = model.fc1.in_features - model.lstm.hidden_size
+    example_inputs = (
+        torch.randn(2, sequence_length, 1, *model.target_shape),
+        torch.randn(3, n_time_features),
+        torch.tensor([0, 1, 1]),
+    )
+    # Newer torch releases default to the dynamo exporter; stay on the TorchScript exporter dynamic_axes is written for
+    export_kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(
+            IndexedHybridModel(model),
+            example_inputs,
+            onnx_path,
+            input_names=ONNX_INPUT_NAMES,
+            output_names=[ONNX_OUTPUT_NAME],
+            dynamic_axes={
+                'evi_sequences': {0: 'sequences', 1: 'sequence_length'},
+                'time_features': {0: 'batch'},
+                'frame_index': {0: 'batch'},
+                ONNX_OUTPUT_NAME: {0: 'batch'},
+            },
+            opset_version=opset_version,
+            **export_kwargs,
+        )
+    return onnx_path
+
+
+# ONNX Runtime backend for a model exported with export_onnx, running on the CPU execution provider.
+# Instances can be passed anywhere a HybridModel is accepted by predict / predict_batch / predict_weekly_yield.
+class OnnxYieldModel:
+    def __init__(self, onnx_path, intra_op_num_threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("OnnxYieldModel needs onnxruntime (pip install onnxruntime)") from e
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_num_threads is not None:
+            options.intra_op_num_threads = intra_op_num_threads
+        self.onnx_path = onnx_path
+        self.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+
+    # evi_sequences is (sequences, time_steps, 1, H, W), time_features is (batch, n_features) and
+    # frame_index (batch,) picks the sequence for each row; it defaults to one row per sequence
+    def __call__(self, evi_sequences, time_features, frame_index=None):
+        if frame_index is None:
+            frame_index = np.arange(len(evi_sequences))
+        inputs = {
+            'evi_sequences': np.ascontiguousarray(evi_sequences, dtype=np.float32),
+            'time_features': np.ascontiguousarray(time_features, dtype=np.float32),
+            'frame_index': np.ascontiguousarray(frame_index, dtype=np.int64),
+        }
+        return self.session.run([ONNX_OUTPUT_NAME], inputs)[0]
+
+
+# Function to compare an exported model against the PyTorch model on random inputs.
+# Returns the largest absolute difference relative to the largest PyTorch output.
+def check_onnx_parity(model, onnx_model, n_sequences=2, batch_size=3, sequence_length=2, seed=0):
+    import torch
+
+    rng = np.random.default_rng(seed)
+    n_time_features = model.fc1.in_features - model.lstm.hidden_size
+    evi_sequences = rng.standard_normal((n_sequences, sequence_length, 1, *model.target_shape)).astype(np.float32)
+    time_features = rng.standard_normal((batch_size, n_time_features)).astype(np.float32)
+    frame_index = rng.integers(0, n_sequences, batch_size)
+
+    model.eval()
+    with torch.no_grad():
+        expected = model(torch.from_numpy(evi_sequences[frame_index]), torch.from_numpy(time_features)).numpy()
+    actual = onnx_model(evi_sequences, time_features, frame_index)
+    return float(np.abs(actual - expected).max() / max(np.abs(expected).max(), 1e-6))
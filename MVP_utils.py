@@ -3,6 +3,7 @@ from pathlib import Path
 import numpy as np
 import pandas as pd
 import rasterio
+from rasterio.enums import Resampling
 from sklearn.preprocessing import MinMaxScaler
 
 
@@ -12,9 +13,27 @@ def load_evi_data(file_path):
         data = src.read(1)
         return data
 
-
-
-def process_yield_data(yield_data_path:Path):
+# Function to load EVI data already decimated to out_shape (height, width) as float32.
+# GDAL resamples while decoding and starts from the closest internal overview when the file has any
+# (use_overviews=False forces the full-resolution band), so the full raster is never materialized.
+# resampling is a rasterio Resampling name; 'bilinear' is the closest match to skimage's anti-aliased resize.
+# Integer rasters are scaled the way skimage's resize does it (divided by the dtype max), so the values, and any
+# normalization stats computed from them, are interchangeable with resize(load_evi_data(...)).
+def load_evi_data_decimated(file_path, out_shape, resampling='bilinear', use_overviews=True):
+    open_options = {} if use_overviews else {'OVERVIEW_LEVEL': 'NONE'}
+    with rasterio.open(file_path, **open_options) as src:
+        data = src.read(1, out_shape=tuple(out_shape), resampling=Resampling[resampling], out_dtype='float32')
+        dtype = np.dtype(src.dtypes[0])
+    if np.issubdtype(dtype, np.integer):
+        data /= np.iinfo(dtype).max
+        if np.issubdtype(dtype, np.signedinteger):
+            np.maximum(data, -1, out=data)
+    return data
+
+
+# return_scaler=True also returns the fitted MinMaxScaler, so it can be shipped with the model
+# (see MVP_artifact_utils.save_model_artifact)
+def process_yield_data(yield_data_path:Path, return_scaler=False):
 
     # Load yield data
     yield_data = pd.read_csv(yield_data_path, parse_dates=['Date'], index_col='Date')
@@ -72,4 +91,6 @@ def process_yield_data(yield_data_path:Path):
     scaler = MinMaxScaler()
     yield_data_weekly[['Volume (Pounds)', 'Cumulative Volumne (Pounds)']] = scaler.fit_transform(yield_data_weekly[['Volume (Pounds)', 'Cumulative Volumne (Pounds)']])
 
+    if return_scaler:
+        return yield_data_weekly, scaler
     return yield_data_weekly
\ No newline at end of file